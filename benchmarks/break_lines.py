@@ -0,0 +1,127 @@
+"""
+    Differential test and benchmark of `pillow_helpers.break_lines` against the straightforward algorithm it replaced:
+    try the whole paragraph on one line, and drop words from the end until it fits, measuring each attempt.
+
+    The reference keeps a word that's wider than the line on a line of its own (the old function also dropped the
+    word after it, which was a bug). Both are run on a corpus of headlines and commentary, in every face, at several
+    sizes and widths, drawing as the routes do (onto a palette image) and with antialiasing. Run from the repository
+    root:
+
+        python -m benchmarks.break_lines          # check, then time both on longer paragraphs
+        python -m benchmarks.break_lines --check  # just check
+
+    Exits with status 1 on any difference.
+"""
+
+import argparse
+import sys
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFont
+
+from f1cal.font import F1Bold, F1Reg, F1Wide, font_paths, read_font_file
+from f1cal.pillow_helpers import break_lines
+
+CORPUS = [
+    "2022 British Grand Prix",
+    "\"Leclerc has that inside line. Perez goes off the track, cuts the chicane. Off goes Leclerc...\"",
+    "Through goes Hamilton, unbelievable stuff!",
+    "F1: Grand Prix (Australian Grand Prix)",
+    "F1: Grand Prix (Gran Premio de la Ciudad de México)",
+    "It's lights out and away we go, and a good start from pole, but there's contact into turn one!",
+    "Box box, box box. Stay out, stay out. We are checking. Copy, we are checking.",
+    "Supercalifragilisticexpialidocious is wider than the narrowest of lines, so it goes on a line of its own",
+    "Verstappen Norris Piastri Leclerc Hamilton Russell Antonelli Alonso Stroll Gasly Ocon Albon Sainz Hülkenberg",
+    "AVA",
+    "a",
+    "",
+    "   spaces   between   words   ",
+]
+FACES = {"F1Reg": F1Reg, "F1Bold": F1Bold, "F1Wide": F1Wide}
+SIZES = (12, 21, 36, 56)
+WIDTHS = (120, 400, 720)
+# Words per paragraph for the timings (the reference takes seconds at 100).
+PARAGRAPH_WORDS = (10, 30, 100)
+
+
+def reference_break_lines(text: str, draw: ImageDraw.ImageDraw, font: ImageFont.ImageFont, width: int) -> list[str]:
+    lines = []
+    words = text.split()
+    while words:
+        line = words.copy()
+        while line and draw.textlength(' '.join(line), font=font) > width:
+            line.pop()
+        if not line:
+            line = words[:1]
+        del words[:len(line)]
+        lines.append(' '.join(line))
+    return lines
+
+
+def draws() -> dict[str, ImageDraw.ImageDraw]:
+    """
+        A draw with each font mode the routes might use: palette images get 1-bit text, RGB ones antialiased.
+    """
+    return {mode: ImageDraw.Draw(Image.new(mode, (1, 1))) for mode in ("P", "RGB")}
+
+
+def check() -> bool:
+    cases = 0
+    mismatches = 0
+    for mode, draw in draws().items():
+        for face_name, face in FACES.items():
+            for size in SIZES:
+                font = face(size)
+                for width in WIDTHS:
+                    for text in CORPUS:
+                        cases += 1
+                        expected = reference_break_lines(text, draw, font, width)
+                        actual = list(break_lines(text, draw, font, width))
+                        if actual != expected:
+                            mismatches += 1
+                            print(f"MISMATCH: {mode} {face_name} {size}pt, {width}px: {text!r}\n"
+                                  f"  reference:   {expected}\n  break_lines: {actual}")
+    print(f"{cases - mismatches} of {cases} cases match")
+    return mismatches == 0
+
+
+def best_time(algorithm, text: str, draw: ImageDraw.ImageDraw, repeat: int) -> float:
+    """
+        Best time of `repeat` runs, in seconds. Each run is from cold: word widths are cached per font, so each gets a
+        fresh face (made outside the timing).
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        font = ImageFont.truetype(BytesIO(read_font_file(font_paths[0])), 32)
+        start = time.perf_counter()
+        list(algorithm(text, draw, font, 400))
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark(repeat: int):
+    draw = draws()["P"]
+    words = " ".join(CORPUS).split()
+    for n in PARAGRAPH_WORDS:
+        text = " ".join(words[i % len(words)] for i in range(n))
+        times = {name: best_time(algorithm, text, draw, repeat)
+                 for name, algorithm in (("reference", reference_break_lines), ("break_lines", break_lines))}
+        print(f"{n:4} words: reference {times['reference'] * 1000:8.2f} ms, "
+              f"break_lines {times['break_lines'] * 1000:8.2f} ms")
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--check", action="store_true", help="only check the output, without timing")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per timing (the best is reported)")
+    args = parser.parse_args(argv)
+
+    ok = check()
+    if not args.check:
+        benchmark(args.repeat)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
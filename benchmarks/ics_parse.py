@@ -0,0 +1,170 @@
+"""
+    Differential test and benchmark of `fast_ics` against `icalendar`.
+
+    For each feed, checks that both parsers give the same `F1Event`s, then times them and measures how much memory
+    a parse takes (peak RSS growth, and the tracemalloc peak) in a fresh process per parser. Run from the repository
+    root, with recorded feeds:
+
+        python -m benchmarks.ics_parse path/to/feed.ics ...
+        python -m benchmarks.ics_parse --check  # just check, without timing
+
+    Without arguments, it uses the recorded feed in benchmarks/fixtures and the feeds in the calendar cache directory.
+    A small feed of awkward cases (folding, escapes, time zones, all-day events, alarms) is always checked too. Exits
+    with status 1 on any difference.
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+import icalendar
+
+from f1cal.data_sources import fast_ics
+from f1cal.data_sources.events import F1Event
+from f1cal.data_sources.ics_cache import DEFAULT_CACHE_DIR
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "f1-calendar_gp.ics")
+
+EDGE_CASES = b"""BEGIN:VCALENDAR\r
+VERSION:2.0\r
+PRODID:-//f1cal//edge cases//EN\r
+BEGIN:VEVENT\r
+UID:folded@example.com\r
+DTSTART:20260301T120000Z\r
+DTEND:20260301T140000Z\r
+SUMMARY:F1: Grand Prix (A Very Long Grand Prix Name That Gets Folded Across\r
+  Several Lines)\r
+LOCATION:Somewhere\\, with a comma\\; and a semicolon\\nand a newline\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:tzid@example.com\r
+DTSTART;TZID=Europe/London:20260329T003000\r
+DTEND;TZID="America/Sao_Paulo":20260329T120000\r
+SUMMARY:No series in this summary\r
+CATEGORIES:Practice\\, 1,Formula 1\r
+CATEGORIES:Ignored\r
+BEGIN:VALARM\r
+ACTION:DISPLAY\r
+DESCRIPTION:Reminder\r
+TRIGGER:-PT30M\r
+SUMMARY:Not the event's summary\r
+END:VALARM\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:all-day@example.com\r
+DTSTART;VALUE=DATE:20260704\r
+DTEND;VALUE=DATE:20260705\r
+SUMMARY;LANGUAGE=en:F2: Feature Race (British Grand Prix)\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:floating@example.com\r
+DTSTART:20261025T190000\r
+summary:lower-case names\r
+X-PARAM;X-NOTE="a:b;c":ignored\r
+END:VEVENT\r
+END:VCALENDAR\r
+"""
+
+
+def icalendar_events(raw: bytes) -> list[F1Event]:
+    return [F1Event.from_ical(ev) for ev in icalendar.Calendar.from_ical(raw).walk("VEVENT")]
+
+
+def fast_events(raw: bytes) -> list[F1Event]:
+    return list(fast_ics.iter_events(raw))
+
+
+PARSERS = {"icalendar": icalendar_events, "fast_ics": fast_events}
+
+
+def fields(event: F1Event) -> tuple:
+    return tuple(getattr(event, name) for name in F1Event.__slots__)
+
+
+def compare(name: str, raw: bytes) -> bool:
+    expected = [fields(event) for event in icalendar_events(raw)]
+    actual = [fields(event) for event in fast_events(raw)]
+    if expected == actual:
+        print(f"{name}: {len(actual)} events match")
+        return True
+
+    print(f"{name}: MISMATCH ({len(expected)} events from icalendar, {len(actual)} from fast_ics)")
+    for i, (e, a) in enumerate(zip(expected, actual)):
+        if e != a:
+            print(f"  event {i}:\n    icalendar: {e}\n    fast_ics:  {a}")
+    return False
+
+
+def time_parser(parser, raw: bytes, repeat: int) -> float:
+    """
+        Best time of `repeat` parses, in seconds.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parser(raw)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def measure_memory(parser_name: str, path: str, results):
+    # Runs in a fresh process, so that the peak RSS is this parse's alone.
+    with open(path, "rb") as f:
+        raw = f.read()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    events = PARSERS[parser_name](raw)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux, bytes on macOS.
+    scale = 1 if sys.platform == "darwin" else 1024
+    results.put(((after - before) * scale, peak, len(events)))
+
+
+def memory(parser_name: str, path: str) -> tuple[int, int, int]:
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=measure_memory, args=(parser_name, path, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("feeds", nargs="*",
+                        help="ICS files (default: the recorded fixture, and the feeds in the calendar cache)")
+    parser.add_argument("--check", action="store_true", help="only compare the parsers' output, without timing")
+    parser.add_argument("--repeat", type=int, default=20, help="parses per timing (the best is reported)")
+    args = parser.parse_args(argv)
+
+    paths = args.feeds or [FIXTURE] + sorted(glob.glob(os.path.join(DEFAULT_CACHE_DIR, "*.ics")))
+    ok = compare("edge cases", EDGE_CASES)
+
+    for path in paths:
+        with open(path, "rb") as f:
+            raw = f.read()
+        name = os.path.basename(path)
+        ok = compare(name, raw) and ok
+        if args.check:
+            continue
+
+        print(f"  {len(raw) / 1024:.0f} KiB")
+        for parser_name, parse in PARSERS.items():
+            seconds = time_parser(parse, raw, args.repeat)
+            rss, peak, _ = memory(parser_name, path)
+            print(f"  {parser_name:<10} {seconds * 1000:8.2f} ms  peak RSS +{rss / 1024:6.0f} KiB  "
+                  f"tracemalloc peak {peak / 1024:6.0f} KiB")
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+    Load test for the render pool: requests per second for uncached countdown images, by number of render workers.
+
+    Requests go straight to the WSGI app (no sockets), each with the clock pinned to a different day, so that every
+    request misses the render cache and really renders. Run from the repository root:
+
+        python -m benchmarks.load_test --workers 0,1,2,4 --ics path/to/calendar.ics
+
+    With `--ics`, the calendar is read from that file (through a temporary cache directory) instead of the network.
+"""
+
+import argparse
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", default="0,1,2,4",
+                        help="comma-separated render worker counts to try (0: render in the request threads)")
+    parser.add_argument("--requests", type=int, default=200, help="requests per run")
+    parser.add_argument("--concurrency", type=int, default=8, help="request threads")
+    parser.add_argument("--format", default="png", help="image format to ask for")
+    parser.add_argument("--start", default="2026-01-01", help="first day to pin the clock to")
+    parser.add_argument("--ics", help="serve this ICS file rather than fetching the calendar")
+    return parser.parse_args(argv)
+
+
+def use_fixture(ics_path: str) -> str:
+    """
+        Point the calendar cache at a temporary directory holding `ics_path` as the first feed, freshly "fetched".
+        Must happen before f1cal is imported; render workers inherit the environment.
+    """
+    cache_dir = tempfile.mkdtemp(prefix="f1cal-load-")
+    os.environ["F1CAL_CACHE_DIR"] = cache_dir
+
+    from f1cal.data_sources import schedule
+
+    _, cache = schedule.feeds[0]
+    shutil.copy(ics_path, cache.ics_path)
+    with open(cache.meta_path, "w") as f:
+        json.dump({"fetched_at": time.time()}, f)
+    return cache_dir
+
+
+def get(app, path: str, query: str = "", headers: dict[str, str] | None = None) -> tuple[str, bytes]:
+    environ = {
+        "REQUEST_METHOD": "GET", "PATH_INFO": path, "QUERY_STRING": query, "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80", "wsgi.url_scheme": "http", "wsgi.input": io.BytesIO(),
+    }
+    for name, value in (headers or {}).items():
+        environ["HTTP_" + name.upper().replace("-", "_")] = value
+    status = []
+    body = b"".join(app(environ, lambda s, headers, exc_info=None: status.append(s)))
+    return status[0], body
+
+
+def run_requests(app, times: list[float], fmt: str, concurrency: int) -> float:
+    """
+        Request the countdown once at each of `times` from `concurrency` threads. Returns the elapsed seconds.
+    """
+    from f1cal import clock
+
+    pending = iter(times)
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        while True:
+            with lock:
+                t = next(pending, None)
+            if t is None:
+                return
+            with clock.pinned(t):
+                status, _ = get(app, "/inky/countdown", f"format={fmt}")
+            if not status.startswith("200"):
+                errors.append(status)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    if errors:
+        raise RuntimeError(f"{len(errors)} requests failed, e.g. {errors[0]}")
+    return elapsed
+
+
+def main(argv: list[str] | None = None):
+    args = parse_args(argv)
+    cache_dir = use_fixture(args.ics) if args.ics else None
+
+    from bottle import default_app
+    from datetime import datetime as dt, timezone as tz
+
+    from f1cal import render_pool, routes
+    from f1cal.data_sources import schedule
+    from f1cal.pillow_helpers import render_cache
+
+    schedule.set_background()
+    schedule.get_event_index()
+    app = default_app()
+    start = dt.fromisoformat(args.start).replace(tzinfo=tz.utc).timestamp()
+
+    print(f"{os.cpu_count()} CPUs; {args.requests} requests from {args.concurrency} threads "
+          f"({routes.__name__}, format={args.format})")
+    baseline = None
+    try:
+        for workers in (int(n) for n in args.workers.split(",")):
+            if workers > 0:
+                render_pool.start(workers)
+            try:
+                # A different day (so a different image) for every request, and a warm-up round that the timed
+                # requests don't repeat, so the workers are up and nothing is served from the render cache.
+                warmup = [start + (i + 0.5) * SECONDS_PER_DAY for i in range(max(workers, args.concurrency))]
+                times = [start + (len(warmup) + i + 0.5) * SECONDS_PER_DAY for i in range(args.requests)]
+                run_requests(app, warmup, args.format, args.concurrency)
+                render_cache.clear()
+
+                elapsed = run_requests(app, times, args.format, args.concurrency)
+            finally:
+                render_pool.shutdown()
+            render_cache.clear()
+
+            rate = args.requests / elapsed
+            baseline = baseline or rate
+            print(f"workers={workers:<3} {rate:8.1f} req/s  ({rate / baseline:.2f}x)")
+    finally:
+        if cache_dir is not None:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+    Render benchmark: latency, memory and output size of every image route in every format, plus the text layout and
+    encoding helpers they're built on.
+
+    Routes are requested through the WSGI app (no sockets), against a recorded calendar (benchmarks/fixtures, or
+    `--ics`) with the clock pinned, so every run renders the same images. The render cache is emptied before each
+    request, so every request really draws and encodes. Run from the repository root:
+
+        python -m benchmarks.render --save benchmarks/baselines/render.json    # record a baseline
+        python -m benchmarks.render --compare benchmarks/baselines/render.json # check against it
+
+    `--compare` exits with status 1 if any case's p50 is more than `--tolerance` slower than the baseline. Baselines
+    are only comparable on the same machine (and with the same fonts and Pillow).
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+import tracemalloc
+
+from .load_test import SECONDS_PER_DAY, get, use_fixture
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "f1-calendar_gp.ics")
+FORMATS = ("png", "bmp", "raw", "delta")
+# Words per paragraph for the break_lines cases.
+PARAGRAPH_WORDS = (10, 100, 1000)
+WORDS = "the quick brown fox jumps over the lazy dog while lights out and away we go".split()
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--ics", default=FIXTURE, help="calendar to render from (default: the recorded fixture)")
+    parser.add_argument("--repeat", type=int, default=50, help="timed runs per case")
+    parser.add_argument("--save", metavar="PATH", help="write the results to PATH as a JSON baseline")
+    parser.add_argument("--compare", metavar="PATH", help="compare the results with the baseline at PATH")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="how much slower than the baseline a p50 may be before it's a regression (default: 0.25)")
+    return parser.parse_args(argv)
+
+
+def percentile(samples: list[float], p: float) -> float:
+    """
+        The `p`th percentile of `samples` (nearest rank).
+    """
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+
+def measure(run, repeat: int, reset=None) -> dict[str, float]:
+    """
+        Time `repeat` calls of `run` (calling `reset` before each, untimed), then trace the allocations of one more.
+        `run` returns its output, whose size is reported.
+    """
+    samples = []
+    for _ in range(repeat):
+        if reset is not None:
+            reset()
+        start = time.perf_counter()
+        output = run()
+        samples.append(time.perf_counter() - start)
+
+    if reset is not None:
+        reset()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "peak_alloc_kib": peak / 1024,
+        "bytes": len(output),
+    }
+
+
+def pinned_times() -> dict[str, float]:
+    """
+        A time to pin the clock to for each layout of the countdown: an ordinary countdown, race week, and the
+        off-season (after the last GP).
+    """
+    from f1cal.data_sources import schedule
+
+    first_gp = schedule.get_next_grand_prix(0)
+    last_gp = schedule.get_all_upcoming_grands_prix(0, float("inf"))[-1]
+    return {"countdown": first_gp.start - 30.5 * SECONDS_PER_DAY, "raceweek": first_gp.start - 3.5 * SECONDS_PER_DAY,
+            "offseason": last_gp.start + SECONDS_PER_DAY}
+
+
+def route_cases(app) -> dict[str, tuple[str, float | None]]:
+    """
+        (path, pinned time) for each image route, by case name. Routes that change over time get a case for each of
+        `pinned_times`.
+    """
+    cases = {}
+    for r in app.routes:
+        if (image_route := getattr(r.callback, "image_route", None)) is None:
+            continue
+        if image_route.next_change is None:
+            cases[image_route.name] = (r.rule, None)
+        else:
+            for layout, t in pinned_times().items():
+                cases[f"{image_route.name}@{layout}"] = (r.rule, t)
+    return cases
+
+
+def benchmark_routes(app, repeat: int) -> dict[str, dict[str, float]]:
+    from f1cal import clock
+    from f1cal.pillow_helpers import deltas, etag_for, render_cache
+
+    def reset():
+        render_cache.clear()
+        deltas.clear()
+
+    results = {}
+    for case, (path, t) in route_cases(app).items():
+        with clock.pinned(t if t is not None else time.time()):
+            # An image that never changes has no deltas to measure.
+            for fmt in FORMATS if t is not None else FORMATS[:-1]:
+                headers = {}
+                if fmt == "delta":
+                    # Against the framebuffer of the day before, as a frame waking up daily would ask. In race week
+                    # that's the same image, so the answer is a 304.
+                    with clock.pinned(clock.now() - SECONDS_PER_DAY):
+                        _, base = get(app, path, "format=raw")
+                    headers["If-None-Match"] = etag_for(base)
+
+                def run():
+                    status, body = get(app, path, f"format={fmt}", headers)
+                    if not status.startswith(("200", "304")):
+                        raise RuntimeError(f"{path}?format={fmt} returned {status}")
+                    return body
+
+                results[f"route {case} {fmt}"] = measure(run, repeat, reset)
+    return results
+
+
+def benchmark_helpers(repeat: int) -> dict[str, dict[str, float]]:
+    from PIL import Image, ImageDraw
+
+    from f1cal import clock
+    from f1cal.font import F1Reg
+    from f1cal.pillow_helpers import EPD_INKY, break_lines, canvas, image_routes
+
+    epd = EPD_INKY
+    img = Image.new("P", (epd.WIDTH, epd.HEIGHT))
+    draw = ImageDraw.Draw(img)
+    font = F1Reg(32)
+
+    results = {}
+    for words in PARAGRAPH_WORDS:
+        text = " ".join(WORDS[i % len(WORDS)] for i in range(words))
+        results[f"break_lines {words} words"] = measure(
+            lambda: "\n".join(break_lines(text, draw, font, epd.WIDTH)).encode(), repeat)
+
+    # Encoding alone, of each route's canvas (drawn as `pillow_helpers.render` would) as it is now.
+    for image_route in image_routes:
+        with clock.pinned(pinned_times()["countdown"]):
+            kwargs = image_route.with_state()
+            img = canvas(image_route.route_handler, image_route.epd, image_route.static_layers, **kwargs)
+            image_route.route_handler(ImageDraw.Draw(img), epd=image_route.epd, **kwargs)
+        for fmt in FORMATS[:-1]:
+            results[f"encode {image_route.name} {fmt}"] = measure(
+                lambda: image_route.epd.encoder.encode(img, fmt, image_route.epd.palette), repeat)
+    return results
+
+
+def compare(results: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]], tolerance: float) -> bool:
+    ok = True
+    for case, result in results.items():
+        if (base := baseline.get(case)) is None:
+            print(f"  new: {case}")
+            continue
+        ratio = result["p50_ms"] / base["p50_ms"] if base["p50_ms"] else 1
+        if ratio > 1 + tolerance:
+            ok = False
+            print(f"  REGRESSION: {case}: p50 {base['p50_ms']:.2f} -> {result['p50_ms']:.2f} ms ({ratio:.2f}x)")
+        if result["bytes"] != base["bytes"]:
+            print(f"  output size changed: {case}: {base['bytes']} -> {result['bytes']} bytes")
+    for case in baseline.keys() - results.keys():
+        print(f"  missing: {case}")
+    return ok
+
+
+def main(argv: list[str] | None = None):
+    args = parse_args(argv)
+    cache_dir = use_fixture(args.ics)
+
+    try:
+        from bottle import default_app
+
+        from f1cal import routes
+        from f1cal.data_sources import schedule
+
+        schedule.set_background()
+        schedule.get_event_index()
+        app = default_app()
+
+        # The routes and caches log as they go; keep that out of the report.
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = benchmark_routes(app, args.repeat)
+            results.update(benchmark_helpers(args.repeat))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    print(f"{'case':<44} {'p50 ms':>8} {'p99 ms':>8} {'peak KiB':>9} {'bytes':>8}  ({routes.__name__})")
+    for case, result in results.items():
+        print(f"{case:<44} {result['p50_ms']:8.2f} {result['p99_ms']:8.2f} {result['peak_alloc_kib']:9.0f} "
+              f"{result['bytes']:8}")
+
+    ok = True
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.compare} (recorded {baseline['recorded']} on {baseline['platform']}):")
+        ok = compare(results, baseline["results"], args.tolerance)
+        print("  no regressions" if ok else "  regressions found")
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump({
+                "recorded": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
+                "platform": f"{platform.platform()}, Python {platform.python_version()}, {os.cpu_count()} CPUs",
+                "repeat": args.repeat,
+                "results": results,
+            }, f, indent=2)
+        print(f"Saved baseline to {args.save}")
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
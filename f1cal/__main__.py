@@ -1,12 +1,58 @@
+import argparse
+
 from bottle import run
 
 # Import to run all the decorators
-from . import routes
+from . import metrics, render_pool, routes
 print(f"Imported routes from {routes.__name__}")
 
-print("Running Waitress server on 0.0.0.0:8000...")
+from .data_sources import schedule
+from .pillow_helpers import image_routes
+from .prerender import Prerenderer
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(prog="f1cal", description="Serve F1 calendar images for e-paper frames.")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of render processes (default: 0, i.e. render in the server's own threads)")
+    parser.add_argument("--feed", metavar="SERIES=URL", action="append", type=schedule.parse_feed,
+                        help="an ICS feed to merge into the schedule, tagged with its series (repeatable; default: "
+                             "the F1 grand prix feed, or F1CAL_FEEDS)")
+    parser.add_argument("--fast-ics", action="store_true",
+                        help="parse feeds with the streaming parser rather than icalendar (or set F1CAL_FAST_ICS=1)")
+    parser.add_argument("--metrics-sample", type=float, metavar="FRACTION",
+                        help="fraction of requests to time for /metrics, from 0 to 1 (default: 1, or "
+                             "F1CAL_METRICS_SAMPLE)")
+    args = parser.parse_args(argv)
+
+    if args.metrics_sample is not None:
+        metrics.sample_rate = args.metrics_sample
+
+    if args.feed or args.fast_ics:
+        schedule.configure(args.feed or schedule.feed_config(), args.fast_ics or schedule.fast_parser)
+    print(f"Calendar feeds: {', '.join(f'{series}={url}' for series, url in schedule.feed_config())}")
+
+    # Serve the last schedule straight away, if there's a snapshot of it; the refresher brings it up to date.
+    schedule.load_snapshot()
+    schedule.start_refresher()
+    print("Started background calendar refresher")
+
+    if args.workers > 0:
+        render_pool.start(args.workers)
+        print(f"Started {args.workers} render workers")
+
+    Prerenderer(image_routes).start()
+    print(f"Started pre-renderer for {len(image_routes)} image routes")
+
+    print("Running Waitress server on 0.0.0.0:8000...")
+
+    # This is a very nice API to allow using the default @route decorators with
+    # other WSGI servers
+    # https://bottlepy.org/docs/dev/deployment.html#scaling-for-production
+    # Waitress defaults to 4 threads; with more workers than that, some would sit idle.
+    run(host='0.0.0.0', server='waitress', port=8000, threads=max(4, args.workers))
+
 
-# This is a very nice API to allow using the default @route decorators with
-# other WSGI servers
-# https://bottlepy.org/docs/dev/deployment.html#scaling-for-production
-run(host='0.0.0.0', server='waitress', port=8000)
+# Render workers are spawned, and import this module again (as __mp_main__); only the real main should serve.
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+    ASGI entry point, serving the same routes as `python -m f1cal`:
+
+        uvicorn f1cal.asgi:app
+
+    Connections live in the event loop, so idle frames cost next to nothing. Each request runs through the Bottle
+    (WSGI) app on a thread from a bounded executor, because drawing and encoding are CPU-bound; with F1CAL_WORKERS set,
+    rendering goes on from there to that many render processes (see `render_pool`).
+
+    The calendars are refreshed by a task in the event loop through `httpx.AsyncClient`, which keeps its connections
+    to the upstream alive between fetches and times out rather than hanging, so a slow upstream holds no threads at
+    all. Without httpx installed, the (blocking) fetches run on the executor instead. Feeds are configured with
+    F1CAL_FEEDS (see `schedule`).
+"""
+
+import asyncio
+import io
+import os
+import sys
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from bottle import default_app
+
+from . import render_pool, routes
+from .data_sources import schedule
+from .data_sources.ics_cache import DEFAULT_RETRY_INTERVAL, DEFAULT_TIMEOUT, DEFAULT_TTL
+from .pillow_helpers import image_routes
+from .prerender import Prerenderer
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+__all__ = ["app"]
+
+# Threads for running requests (and parsing the calendar). The event loop itself never renders.
+THREADS = int(os.environ.get("F1CAL_THREADS", 4))
+# Render processes; 0 renders on the request threads.
+WORKERS = int(os.environ.get("F1CAL_WORKERS", 0))
+
+wsgi_app = default_app()
+print(f"Serving routes from {routes.__name__} over ASGI")
+
+_client: "httpx.AsyncClient | None" = None
+_refresh_task: asyncio.Task | None = None
+_prerenderer: Prerenderer | None = None
+
+
+async def app(scope: dict, receive: typing.Callable, send: typing.Callable):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    elif scope["type"] == "http":
+        await http(scope, receive, send)
+    elif scope["type"] == "websocket":
+        await refuse_websocket(receive, send)
+    # Any other kind of connection is ignored (the spec allows an app to do that with scopes it doesn't know).
+
+
+async def refuse_websocket(receive: typing.Callable, send: typing.Callable):
+    """
+        We don't serve websockets: closing before accepting makes the server turn the handshake down (with a 403).
+    """
+    message = await receive()
+    if message["type"] == "websocket.connect":
+        await send({"type": "websocket.close"})
+
+
+async def lifespan(receive: typing.Callable, send: typing.Callable):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await startup()
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": repr(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def startup():
+    global _client, _refresh_task, _prerenderer
+
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix="f1cal-request"))
+
+    # The refresh task owns the calendars; requests never fetch them.
+    schedule.set_background()
+    if httpx is not None:
+        # Enough connections to fetch every feed at once, kept alive until the next refresh.
+        feeds = len(schedule.feeds)
+        _client = httpx.AsyncClient(timeout=DEFAULT_TIMEOUT, follow_redirects=True,
+                                    limits=httpx.Limits(max_connections=feeds, max_keepalive_connections=feeds))
+    else:
+        print("httpx isn't installed; fetching the calendar on the executor")
+
+    if schedule.load_snapshot():
+        # Serve from the snapshot, and refresh straight away in the background.
+        delay = 0
+    else:
+        try:
+            await refresh()
+            delay = DEFAULT_TTL
+        except Exception as e:
+            print(f"Warning: couldn't load the calendar at startup: {e!r}")
+            delay = DEFAULT_RETRY_INTERVAL
+    _refresh_task = asyncio.create_task(refresh_forever(delay))
+    print("Started background calendar refresh task")
+
+    if WORKERS > 0:
+        render_pool.start(WORKERS)
+        print(f"Started {WORKERS} render workers")
+
+    _prerenderer = Prerenderer(image_routes)
+    _prerenderer.start()
+    print(f"Started pre-renderer for {len(image_routes)} image routes")
+
+
+async def shutdown():
+    if _prerenderer is not None:
+        _prerenderer.stop()
+    if _refresh_task is not None:
+        _refresh_task.cancel()
+    if _client is not None:
+        await _client.aclose()
+    render_pool.shutdown()
+
+
+async def refresh():
+    if _client is not None:
+        await schedule.refresh_async(_client)
+    else:
+        await asyncio.get_running_loop().run_in_executor(None, schedule.refresh)
+
+
+async def refresh_forever(delay: float):
+    """
+        The event loop's version of `Refresher`, starting after `delay` seconds.
+    """
+    while True:
+        await asyncio.sleep(delay)
+        start = time.monotonic()
+        try:
+            await refresh()
+            delay = DEFAULT_TTL
+        except Exception as e:
+            print(f"Warning: background refresh failed: {e!r}")
+            delay = DEFAULT_RETRY_INTERVAL
+        print(f"Background refresh took {time.monotonic() - start:.2f}s; next in {delay:.0f}s")
+
+
+async def http(scope: dict, receive: typing.Callable, send: typing.Callable):
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+
+    status, headers, content = await asyncio.get_running_loop().run_in_executor(None, call_wsgi,
+                                                                                wsgi_environ(scope, body))
+
+    await send({
+        "type": "http.response.start",
+        "status": int(status.split(None, 1)[0]),
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+    })
+    await send({"type": "http.response.body", "body": content})
+
+
+def wsgi_environ(scope: dict, body: bytes) -> dict:
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        # WSGI strings are bytes as latin-1; ASGI has already decoded the path as UTF-8.
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+
+def call_wsgi(environ: dict) -> tuple[str, list[tuple[str, str]], bytes]:
+    response = []
+
+    def start_response(status: str, headers: list[tuple[str, str]], exc_info=None):
+        response[:] = [status, headers]
+
+    result = wsgi_app(environ, start_response)
+    try:
+        content = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response[0], response[1], content
@@ -0,0 +1,112 @@
+"""
+    Small in-memory caches shared by the rendering code.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, TypeVar
+
+__all__ = ["LRUCache"]
+
+V = TypeVar("V")
+
+_MISSING = object()
+
+
+class LRUCache(Generic[V]):
+    """
+        A thread-safe, size-bounded LRU cache, with optional expiry. Keeps hit/miss counts for monitoring.
+
+        With `weigh` (e.g. the size of a value in bytes), it's also bounded by the total weight of its values,
+        `maxweight`.
+    """
+    maxsize: int
+    ttl: float | None
+    maxweight: float | None
+    weigh: Callable[[V], float] | None
+    hits: int
+    misses: int
+    # Total weight of the values in the cache.
+    weight: float
+
+    def __init__(self, maxsize: int, ttl: float | None = None, maxweight: float | None = None,
+                 weigh: Callable[[V], float] | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self.hits = 0
+        self.misses = 0
+        self.weight = 0
+        self._lock = threading.Lock()
+        # key -> (expiry, value, weight)
+        self._data: OrderedDict[Hashable, tuple[float, V, float]] = OrderedDict()
+
+    def get(self, key: Hashable, default=None) -> V | None:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING or entry[0] <= time.monotonic():
+                if entry is not _MISSING:
+                    self._remove(key)
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: V, ttl: float | None = None):
+        if ttl is None:
+            ttl = self.ttl
+        expiry = float("inf") if ttl is None else time.monotonic() + ttl
+        weight = self.weigh(value) if self.weigh is not None else 0
+
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (expiry, value, weight)
+            self.weight += weight
+            # Always keep the newest entry, even if it weighs more than `maxweight` on its own.
+            while len(self._data) > self.maxsize or (
+                    self.maxweight is not None and self.weight > self.maxweight and len(self._data) > 1):
+                self._remove(next(iter(self._data)))
+
+    def _remove(self, key: Hashable):
+        self.weight -= self._data.pop(key)[2]
+
+    def get_or_create(self, key: Hashable, create: Callable[[], V], ttl: float | None = None) -> V:
+        """
+            Return the cached value for `key`, calling `create` (outside the lock) to fill it on a miss.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = create()
+            self.put(key, value, ttl)
+        return value
+
+    def discard_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """
+            Drop every entry whose key matches `predicate`. Returns how many were dropped.
+        """
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def items(self) -> list[tuple[Hashable, V]]:
+        """
+            The unexpired entries, least recently used first. Doesn't count as using them.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value) for key, (expiry, value, _) in self._data.items() if expiry > now]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,40 @@
+"""
+    The time as far as layouts are concerned.
+
+    Everything that decides what an image shows should ask this module rather than `time.time()`, so that an image can
+    be rendered as it will look at some other time (e.g. pre-rendering just before the day count changes).
+"""
+
+import contextlib
+import contextvars
+import time
+from datetime import datetime as dt, timezone as tz
+from typing import Iterator
+
+__all__ = ["now", "now_datetime", "pinned"]
+
+_pinned: contextvars.ContextVar[float | None] = contextvars.ContextVar("pinned", default=None)
+
+
+def now() -> float:
+    """
+        Current time, as epoch seconds.
+    """
+    pinned_time = _pinned.get()
+    return time.time() if pinned_time is None else pinned_time
+
+
+def now_datetime() -> dt:
+    return dt.fromtimestamp(now(), tz.utc)
+
+
+@contextlib.contextmanager
+def pinned(t: float) -> Iterator[None]:
+    """
+        Within this context (and only in this thread), `now()` returns `t`.
+    """
+    token = _pinned.set(t)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
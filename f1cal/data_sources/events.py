@@ -0,0 +1,165 @@
+"""
+    Compact, time-indexed representation of the events in a calendar.
+
+    The `icalendar` objects are converted once (per calendar version) into `F1Event` records, sorted by start time,
+    so that "what's next?" is a binary search rather than a sort of the whole calendar. Several feeds can be merged
+    into one index, with each event tagged by the series its feed is for.
+"""
+
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime as dt, timezone as tz
+from typing import Callable, Iterable
+
+import icalendar
+
+__all__ = ["F1Event", "EventIndex"]
+
+# e.g. "F1: Grand Prix (British Grand Prix)"
+SUMMARY_PATTERN = re.compile(r"^\W*(?P<series>[^:]+):\s*(?P<session>[^(]+?)\s*\((?P<name>.*)\)\s*$")
+
+
+def to_epoch(value: dt | date) -> int:
+    """
+        Convert an ICS date or datetime to a UTC epoch timestamp. Naive datetimes and all-day dates are taken as UTC.
+    """
+    if not isinstance(value, dt):
+        value = dt(value.year, value.month, value.day)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=tz.utc)
+    return int(value.timestamp())
+
+
+def session_from_summary(summary: str) -> str | None:
+    if (m := SUMMARY_PATTERN.match(summary)) is not None:
+        return m["session"]
+    return None
+
+
+def first_category(ev: icalendar.Event) -> str:
+    categories = ev.get("CATEGORIES")
+    # One property per CATEGORIES line; each line can hold several comma-separated values.
+    if isinstance(categories, list):
+        categories = categories[0] if categories else None
+    if categories is None or not categories.cats:
+        return ""
+    return str(categories.cats[0])
+
+
+class F1Event:
+    __slots__ = ("uid", "summary", "location", "start", "end", "session", "series")
+
+    uid: str
+    summary: str
+    location: str
+    # UTC epoch seconds
+    start: int
+    end: int
+    # e.g. "Grand Prix", "Qualifying"
+    session: str
+    # The series of the feed the event came from, e.g. "F1", "F2"
+    series: str
+
+    def __init__(self, uid: str, summary: str, location: str, start: int, end: int, session: str, series: str = ""):
+        self.uid = uid
+        self.summary = summary
+        self.location = location
+        self.start = start
+        self.end = end
+        self.session = session
+        self.series = series
+
+    @classmethod
+    def from_ical(cls, ev: icalendar.Event, series: str = "") -> "F1Event":
+        summary = str(ev.get("SUMMARY", ""))
+        start = to_epoch(ev.decoded("DTSTART"))
+        end = to_epoch(ev.decoded("DTEND")) if "DTEND" in ev else start
+
+        if (session := session_from_summary(summary)) is None:
+            session = first_category(ev)
+
+        return cls(str(ev.get("UID", "")), summary, str(ev.get("LOCATION", "")), start, end, session, series)
+
+    @property
+    def dtstart(self) -> dt:
+        return dt.fromtimestamp(self.start, tz.utc)
+
+    @property
+    def dtend(self) -> dt:
+        return dt.fromtimestamp(self.end, tz.utc)
+
+    @property
+    def name(self) -> str:
+        """
+            The event name without the series/session decoration, e.g. "British Grand Prix".
+        """
+        if (m := SUMMARY_PATTERN.match(self.summary)) is not None:
+            return m["name"]
+        return self.summary
+
+    def __repr__(self):
+        return (f"{self.__class__.__name__}(uid={self.uid!r}, summary={self.summary!r}, location={self.location!r}, "
+                f"start={self.dtstart.isoformat()}, end={self.dtend.isoformat()}, session={self.session!r}, "
+                f"series={self.series!r})")
+
+
+class EventIndex:
+    """
+        Events sorted by start time, with the start times held in a parallel array for `bisect`.
+    """
+    events: list[F1Event]
+    starts: array
+
+    def __init__(self, events: Iterable[F1Event]):
+        self.events = sorted(events, key=lambda ev: ev.start)
+        self.starts = array('q', (ev.start for ev in self.events))
+
+    @classmethod
+    def from_calendar(cls, calendar: icalendar.Calendar, series: str = "") -> "EventIndex":
+        return cls.from_calendars([(series, calendar)])
+
+    @classmethod
+    def from_calendars(cls, calendars: Iterable[tuple[str, icalendar.Calendar]]) -> "EventIndex":
+        """
+            Merge (series, calendar) pairs into one index. An event that's in more than one feed (by UID) is kept
+            from the first.
+        """
+        return cls.from_feeds((F1Event.from_ical(ev, series) for ev in calendar.walk("VEVENT"))
+                              for series, calendar in calendars)
+
+    @classmethod
+    def from_feeds(cls, feeds: Iterable[Iterable[F1Event]]) -> "EventIndex":
+        """
+            Merge the events of several feeds into one index. An event that's in more than one feed (by UID) is kept
+            from the first.
+        """
+        events: dict[str, F1Event] = {}
+        for feed in feeds:
+            for event in feed:
+                # Events without a UID can't be matched up, so keep them all.
+                events.setdefault(event.uid or str(id(event)), event)
+        return cls(events.values())
+
+    def __len__(self):
+        return len(self.events)
+
+    def next_after(self, t: float, where: Callable[[F1Event], bool] | None = None) -> F1Event | None:
+        """
+            The first event starting after `t` (epoch seconds) for which `where` (if given) is true, or None if there
+            isn't one.
+        """
+        for i in range(bisect_right(self.starts, t), len(self.events)):
+            event = self.events[i]
+            if where is None or where(event):
+                return event
+        return None
+
+    def between(self, start: float, end: float, where: Callable[[F1Event], bool] | None = None) -> list[F1Event]:
+        """
+            All events starting in the half-open range [start, end), for which `where` (if given) is true.
+        """
+        events = self.events[bisect_left(self.starts, start):bisect_left(self.starts, end)]
+        if where is None:
+            return events
+        return [event for event in events if where(event)]
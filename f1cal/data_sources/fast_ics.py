@@ -0,0 +1,189 @@
+"""
+    A streaming parser for just the parts of an ICS feed that `F1Event` needs.
+
+    `icalendar` builds an object tree for the whole feed, with every property of every component, only for us to read
+    six of them. This reads the feed a line at a time as a generator, unfolding continuation lines, and makes each
+    `F1Event` straight from a VEVENT's UID, SUMMARY, LOCATION, DTSTART, DTEND and CATEGORIES, keeping nothing else.
+
+    It's opt-in (`--fast-ics`, or `schedule.configure(..., fast=True)`). Anything it doesn't handle the way
+    `icalendar` would (e.g. a TZID that isn't an IANA zone name, which `icalendar` would look up in the feed's
+    VTIMEZONEs) raises `Unsupported`, so the caller can fall back to `icalendar`. benchmarks/ics_parse.py checks that
+    both parsers give the same events for a feed, and compares their speed and memory use.
+"""
+
+import calendar
+import io
+from datetime import datetime as dt
+from typing import Iterator
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from .events import F1Event, session_from_summary
+
+__all__ = ["iter_events", "Unsupported"]
+
+# Properties we keep; the rest are skipped without being parsed.
+WANTED = frozenset(("UID", "SUMMARY", "LOCATION", "DTSTART", "DTEND", "CATEGORIES"))
+
+
+class Unsupported(Exception):
+    """
+        The feed uses something this parser doesn't handle; parse it with `icalendar` instead.
+    """
+
+
+def unfolded_lines(raw: bytes) -> Iterator[bytes]:
+    """
+        The content lines of `raw`, with folded (continuation) lines joined back up and line endings removed.
+    """
+    line = None
+    for physical in io.BytesIO(raw):
+        physical = physical.rstrip(b"\r\n")
+        if physical[:1] in (b" ", b"\t"):
+            if line is not None:
+                line += physical[1:]
+            continue
+        if line is not None:
+            yield line
+        line = physical
+    if line:
+        yield line
+
+
+def split_line(line: str) -> tuple[str, dict[str, str], str]:
+    """
+        Split a content line into its (upper-cased) name, parameters and value.
+    """
+    head, sep, value = line.partition(":")
+    if '"' in head:
+        # A quoted parameter value can contain ':' (and ';'), so find the first colon outside quotes.
+        quoted = False
+        for i, c in enumerate(line):
+            if c == '"':
+                quoted = not quoted
+            elif c == ":" and not quoted:
+                head, sep, value = line[:i], ":", line[i + 1:]
+                break
+    if not sep:
+        raise ValueError(f"Not a content line: {line!r}")
+
+    name, *params = split_unquoted(head, ";")
+    parameters = {}
+    for param in params:
+        key, _, param_value = param.partition("=")
+        parameters[key.upper()] = param_value.strip('"')
+    return name.upper(), parameters, value
+
+
+def split_unquoted(text: str, separator: str) -> list[str]:
+    if '"' not in text:
+        return text.split(separator)
+    parts = []
+    quoted = False
+    start = 0
+    for i, c in enumerate(text):
+        if c == '"':
+            quoted = not quoted
+        elif c == separator and not quoted:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
+
+
+def unescape_text(value: str) -> str:
+    # In the same order as icalendar, which matters for e.g. "\\n".
+    return (value.replace("\\N", "\\n").replace("\\n", "\n").replace("\\,", ",").replace("\\;", ";")
+            .replace("\\\\", "\\"))
+
+
+def first_category(value: str) -> str:
+    """
+        The first of a CATEGORIES line's comma-separated values.
+    """
+    i = 0
+    while (i := value.find(",", i)) != -1:
+        # Count the backslashes before the comma: an odd number means it's escaped.
+        backslashes = len(value[:i]) - len(value[:i].rstrip("\\"))
+        if backslashes % 2 == 0:
+            return unescape_text(value[:i])
+        i += 1
+    return unescape_text(value)
+
+
+def to_epoch(value: str, parameters: dict[str, str]) -> int:
+    """
+        A DATE or DATE-TIME value as UTC epoch seconds, as `events.to_epoch` would give for `icalendar`'s value.
+    """
+    value = value.strip()
+    if parameters.get("VALUE", "").upper() == "DATE" or len(value) == 8:
+        if len(value) != 8 or not value.isdigit():
+            raise ValueError(f"Bad date: {value!r}")
+        return calendar.timegm((int(value[:4]), int(value[4:6]), int(value[6:8]), 0, 0, 0))
+
+    if len(value) not in (15, 16) or value[8] != "T" or not (value[:8] + value[9:15]).isdigit():
+        raise ValueError(f"Bad date-time: {value!r}")
+    fields = (int(value[:4]), int(value[4:6]), int(value[6:8]), int(value[9:11]), int(value[11:13]),
+              int(value[13:15]))
+    if len(value) == 16:
+        if value[15] not in "Zz":
+            raise ValueError(f"Bad date-time: {value!r}")
+        return calendar.timegm(fields)
+
+    tzid = parameters.get("TZID")
+    if tzid is None:
+        # Floating time: taken as UTC, like everything else without a zone.
+        return calendar.timegm(fields)
+    try:
+        zone = ZoneInfo(tzid)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        raise Unsupported(f"Unknown TZID {tzid!r}") from e
+    return int(dt(*fields, tzinfo=zone).timestamp())
+
+
+def iter_events(raw: bytes, series: str = "") -> Iterator[F1Event]:
+    """
+        Yield an `F1Event` for each VEVENT in `raw`, in feed order.
+    """
+    # Components we're inside, innermost last. Only properties directly in a VEVENT count (not e.g. its VALARMs).
+    stack = []
+    props = None
+    for line in unfolded_lines(raw):
+        line = line.decode("utf-8", "replace")
+        keyword = line[:6].upper()
+        if keyword == "BEGIN:" or keyword.startswith("END:"):
+            value = line[len(keyword) if keyword == "BEGIN:" else 4:].strip().upper()
+            if keyword == "BEGIN:":
+                stack.append(value)
+                if value == "VEVENT":
+                    props = {}
+            else:
+                if not stack or stack[-1] != value:
+                    raise ValueError(f"Unexpected END:{value}")
+                stack.pop()
+                if value == "VEVENT":
+                    yield make_event(props, series)
+                    props = None
+            continue
+
+        if not stack or stack[-1] != "VEVENT":
+            continue
+        name = line[:line.find(":") if ":" in line else len(line)].split(";", 1)[0].upper()
+        if name in WANTED and name not in props:
+            props[name] = split_line(line)[1:]
+
+    if stack:
+        raise ValueError(f"Unterminated {stack[-1]}")
+
+
+def make_event(props: dict[str, tuple[dict[str, str], str]], series: str) -> F1Event:
+    if "DTSTART" not in props:
+        raise ValueError("VEVENT without DTSTART")
+    start = to_epoch(props["DTSTART"][1], props["DTSTART"][0])
+    end = to_epoch(props["DTEND"][1], props["DTEND"][0]) if "DTEND" in props else start
+
+    summary = unescape_text(props["SUMMARY"][1]) if "SUMMARY" in props else ""
+    if (session := session_from_summary(summary)) is None:
+        session = first_category(props["CATEGORIES"][1]) if "CATEGORIES" in props else ""
+
+    return F1Event(unescape_text(props["UID"][1]) if "UID" in props else "", summary,
+                   unescape_text(props["LOCATION"][1]) if "LOCATION" in props else "", start, end, session, series)
@@ -0,0 +1,329 @@
+"""
+    Two-level cache for remote ICS feeds: the raw feed is kept on disk, and the parsed calendar is kept in memory.
+
+    Refreshes use conditional GETs (`If-None-Match` / `If-Modified-Since`), so an unchanged feed costs a 304 and no
+    re-parse. If the upstream can't be reached, whatever we already have is served (however stale it is). The on-disk
+    copy can be shared by several processes; with `offline` set (as in the render workers), a cache only ever reads it.
+
+    Refreshes are single-flight: concurrent callers that find the cache stale share one upstream request. With
+    `background` set (i.e. a `Refresher` owns refreshing), `get()` never touches the network once warm.
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import typing
+
+import icalendar
+import requests
+
+from .. import metrics
+
+try:
+    # Optional: only `refresh_async` needs it.
+    import httpx
+except ImportError:
+    httpx = None
+
+__all__ = ["ICSCache", "FetchError", "DEFAULT_CACHE_DIR", "DEFAULT_TTL"]
+
+DEFAULT_CACHE_DIR = os.environ.get("F1CAL_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "f1cal"))
+
+# The calendar changes a handful of times a season, so an hour is plenty fresh.
+DEFAULT_TTL = 60 * 60
+
+# After a failed fetch, wait this long before trying the upstream again (rather than retrying on every request).
+DEFAULT_RETRY_INTERVAL = 60
+
+DEFAULT_TIMEOUT = 10
+
+T = typing.TypeVar("T")
+
+
+class FetchError(Exception):
+    """
+        Raised when there is no cached copy of a feed, and it couldn't be fetched either.
+    """
+
+
+class ICSCache(typing.Generic[T]):
+    url: str
+    # Names the files in the cache directory, and the feed in metrics.
+    name: str
+    ttl: float
+    retry_interval: float
+    timeout: float
+    session: requests.Session | None
+    # Turns the feed's bytes into what's kept in memory. Should raise ValueError if they aren't a calendar.
+    parse: typing.Callable[[bytes], T]
+
+    # When True, `get()` serves stale data rather than refreshing inline; something else is expected to refresh.
+    background: bool
+    # When True, `get()` never goes to the network, even with nothing cached: only the on-disk copy is used.
+    offline: bool
+
+    def __init__(self, url: str, name: str, cache_dir: str = DEFAULT_CACHE_DIR, ttl: float = DEFAULT_TTL,
+                 retry_interval: float = DEFAULT_RETRY_INTERVAL, timeout: float = DEFAULT_TIMEOUT,
+                 session: requests.Session | None = None,
+                 parse: typing.Callable[[bytes], T] = icalendar.Calendar.from_ical):
+        self.url = url
+        self.name = name
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self.background = False
+        self.offline = False
+        # Shared with other caches, to pool connections; None makes a fresh connection for every fetch.
+        self.session = session
+        self.parse = parse
+
+        self.ics_path = os.path.join(cache_dir, f"{name}.ics")
+        self.meta_path = os.path.join(cache_dir, f"{name}.json")
+
+        # (version, calendar), swapped as a unit so readers always see a matching pair.
+        # The version goes up every time the content of the feed changes, so dependants know when to rebuild.
+        self._current: tuple[int, T] | None = None
+        self._refresh_lock = threading.Lock()
+        self._refresh_count = 0
+        self._etag: str | None = None
+        self._last_modified: str | None = None
+        self._fetched_at: float = 0
+        self._next_check: float = 0
+        # Modification time of the on-disk copy when we last read or wrote it.
+        self._disk_mtime: int | None = None
+
+    @property
+    def version(self) -> int:
+        current = self._current
+        return 0 if current is None else current[0]
+
+    def get(self) -> T:
+        """
+            Return the parsed calendar, refreshing it from the upstream first if it's older than `ttl`.
+        """
+        return self.get_versioned()[1]
+
+    def get_versioned(self) -> tuple[int, T]:
+        """
+            As `get()`, but also return the version of the calendar.
+        """
+        self._load_disk_once()
+
+        # With nothing cached, only wait for the upstream if it hasn't failed in the last `retry_interval`.
+        if not self.offline and (self._current is None or not self.background) and self.is_stale():
+            self.refresh()
+
+        current = self._current
+        if current is None:
+            raise FetchError(f"Couldn't fetch {self.url} and no cached copy is available")
+        return current
+
+    def _load_disk_once(self):
+        if self._current is None:
+            with self._refresh_lock:
+                if self._current is None:
+                    self.load_disk()
+
+    def is_stale(self, now: float | None = None) -> bool:
+        if now is None:
+            now = time.time()
+        return now >= self._next_check
+
+    def load_disk(self) -> bool:
+        """
+            Populate the in-memory calendar from the on-disk copy, if there is one.
+        """
+        try:
+            with open(self.ics_path, "rb") as f:
+                mtime = os.fstat(f.fileno()).st_mtime_ns
+                raw = f.read()
+            with metrics.timer("parse", feed=self.name):
+                calendar = self.parse(raw)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            print(f"No usable cached ICS at {self.ics_path}: {e}")
+            return False
+
+        try:
+            with open(self.meta_path, "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+
+        self._etag = meta.get("etag")
+        self._last_modified = meta.get("last_modified")
+        self._fetched_at = meta.get("fetched_at", 0)
+        self._next_check = self._fetched_at + self.ttl
+        self._disk_mtime = mtime
+        self._swap(calendar)
+        return True
+
+    def reload_if_changed(self) -> bool:
+        """
+            Re-read the on-disk copy if it has been replaced since we last read or wrote it, e.g. by another process
+            sharing the cache directory. Returns True if the calendar was reloaded.
+        """
+        try:
+            mtime = os.stat(self.ics_path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self._disk_mtime:
+            return False
+        return self.load_disk()
+
+    def refresh(self) -> bool:
+        """
+            Conditionally re-fetch the feed. Returns True if the calendar changed.
+
+            If another thread is already refreshing, wait for it and share its result instead of making a second
+            request. Raises FetchError only if the fetch failed and there is nothing cached to fall back on.
+        """
+        count = self._refresh_count
+        with self._refresh_lock:
+            if self._refresh_count != count:
+                # Somebody else refreshed while we were waiting for the lock.
+                if self._current is None:
+                    raise FetchError(f"Couldn't fetch {self.url} and no cached copy is available")
+                return False
+            try:
+                return self._refresh()
+            finally:
+                self._refresh_count += 1
+
+    def _refresh(self) -> bool:
+        if self._current is None:
+            # Start from the on-disk copy, if any, so that the request can be conditional.
+            self.load_disk()
+
+        now = time.time()
+        try:
+            with metrics.timer("fetch", feed=self.name):
+                res = (self.session or requests).get(self.url, headers=self._conditional_headers(),
+                                                     timeout=self.timeout)
+            return self._received(res.status_code, res.headers, res.content, now)
+        except (requests.RequestException, FetchError, ValueError) as e:
+            return self._failed(e, now)
+
+    async def refresh_async(self, client: "httpx.AsyncClient") -> bool:
+        """
+            As `refresh()`, but fetching through an async client (so waiting on the upstream doesn't hold a thread),
+            and parsing in the event loop's default executor.
+
+            This isn't single-flight with `refresh()`: it's for a single refresh task that owns the cache (see
+            `f1cal.asgi`), with `background` set so that nothing else refreshes. Requests still may, while nothing is
+            cached, so the response is dealt with under the same lock as theirs.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._load_disk_once)
+
+        now = time.time()
+        try:
+            with metrics.timer("fetch", feed=self.name):
+                res = await client.get(self.url, headers=self._conditional_headers(), timeout=self.timeout)
+        except httpx.HTTPError as e:
+            return await loop.run_in_executor(None, self._settle, None, e, now)
+        return await loop.run_in_executor(None, self._settle, res, None, now)
+
+    def _settle(self, res: "httpx.Response | None", error: Exception | None, now: float) -> bool:
+        """
+            Deal with the outcome of a fetch made by `refresh_async`, as `refresh()` would have (and counting as one).
+        """
+        with self._refresh_lock:
+            try:
+                if error is None:
+                    try:
+                        return self._received(res.status_code, res.headers, res.content, now)
+                    except (FetchError, ValueError) as e:
+                        error = e
+                return self._failed(error, now)
+            finally:
+                self._refresh_count += 1
+
+    def _conditional_headers(self) -> dict[str, str]:
+        headers = {}
+        if self._current is not None:
+            if self._etag:
+                headers["If-None-Match"] = self._etag
+            if self._last_modified:
+                headers["If-Modified-Since"] = self._last_modified
+        return headers
+
+    def _received(self, status: int, headers: typing.Mapping[str, str], content: bytes, now: float) -> bool:
+        if status == 304 and self._current is not None:
+            metrics.count("fetches", feed=self.name, result="not_modified")
+            self._fetched(headers, now)
+            return False
+        if not 200 <= status < 300:
+            raise FetchError(f"{self.url} returned HTTP {status}")
+
+        with metrics.timer("parse", feed=self.name):
+            calendar = self.parse(content)
+        metrics.count("fetches", feed=self.name, result="updated")
+        # On disk first, so that anyone reloading from disk once they see the new version gets the new content.
+        self._write_disk(content)
+        self._fetched(headers, now)
+        self._swap(calendar)
+        return True
+
+    def _failed(self, e: Exception, now: float) -> bool:
+        metrics.count("fetches", feed=self.name, result="failed")
+        self._next_check = now + self.retry_interval
+        if self._current is None:
+            raise FetchError(f"Couldn't fetch {self.url} and no cached copy is available") from e
+        print(f"Warning: couldn't refresh {self.url} ({e}); serving copy from "
+              f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(self._fetched_at))}")
+        return False
+
+    def _swap(self, calendar: T):
+        self._current = (self.version + 1, calendar)
+
+    def _fetched(self, headers: typing.Mapping[str, str], now: float):
+        # A 304 may omit validators, in which case keep the ones we sent.
+        self._etag = headers.get("ETag", self._etag)
+        self._last_modified = headers.get("Last-Modified", self._last_modified)
+        self._fetched_at = now
+        self._next_check = now + self.ttl
+        self._write_meta()
+
+    def _write_disk(self, raw: bytes):
+        try:
+            write_atomic(self.ics_path, raw)
+            self._disk_mtime = os.stat(self.ics_path).st_mtime_ns
+        except OSError as e:
+            print(f"Warning: couldn't write {self.ics_path}: {e}")
+
+    def _write_meta(self):
+        meta = {
+            "url": self.url,
+            "etag": self._etag,
+            "last_modified": self._last_modified,
+            "fetched_at": self._fetched_at,
+        }
+        try:
+            write_atomic(self.meta_path, json.dumps(meta).encode())
+        except OSError as e:
+            print(f"Warning: couldn't write {self.meta_path}: {e}")
+
+
+def write_atomic(path: str, data: bytes):
+    """
+        Write-then-rename, so a crash never leaves a half-written file behind. The temporary file is unique to the
+        call, so processes sharing the cache directory can't write over each other's.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
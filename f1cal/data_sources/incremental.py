@@ -0,0 +1,137 @@
+"""
+    Incremental parsing of an ICS feed, for when it changes a little at a time.
+
+    The feed is split into its VEVENT blocks, and each block is hashed. Blocks seen in the previous parse are reused
+    as they were; only new or edited blocks are parsed, in one go. If anything outside the events changes (e.g. a
+    VTIMEZONE the events refer to), everything is parsed again.
+
+    Blocks are parsed by `icalendar`, or with `fast`, by `fast_ics` (falling back to `icalendar` for feeds it can't
+    handle).
+"""
+
+import hashlib
+import re
+import threading
+
+import icalendar
+
+from . import fast_ics
+from .events import F1Event
+
+__all__ = ["IncrementalParser", "ParsedFeed", "EventChanges"]
+
+VEVENT_PATTERN = re.compile(rb"^BEGIN:VEVENT\r?\n.*?^END:VEVENT(?:\r?\n|$)", re.MULTILINE | re.DOTALL)
+# Lines that don't affect an `F1Event`, but may change on every fetch (the time the feed was generated).
+IGNORED_LINE_PATTERN = re.compile(rb"^DTSTAMP[;:].*(?:\r?\n[ \t].*)*(?:\r?\n|$)", re.MULTILINE)
+END_CALENDAR = b"END:VCALENDAR"
+
+
+def chunk_hash(chunk: bytes) -> bytes:
+    return hashlib.blake2b(IGNORED_LINE_PATTERN.sub(b"", chunk), digest_size=16).digest()
+
+
+class ParsedFeed:
+    """
+        The events of one feed, in feed order, with the hash of the VEVENT block each came from (by UID).
+    """
+    events: list[F1Event]
+    hashes: dict[str, bytes]
+    # How many VEVENT blocks had to be parsed, out of all of them.
+    reparsed: int
+
+    def __init__(self, events: list[F1Event], hashes: dict[str, bytes], reparsed: int):
+        self.events = events
+        self.hashes = hashes
+        self.reparsed = reparsed
+
+    def __len__(self):
+        return len(self.events)
+
+
+class EventChanges:
+    """
+        Event UIDs added, changed or removed between two versions of the schedule.
+    """
+    added: set[str]
+    changed: set[str]
+    removed: set[str]
+
+    def __init__(self, added: set[str], changed: set[str], removed: set[str]):
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+
+    @classmethod
+    def between(cls, old: dict[str, bytes], new: dict[str, bytes]) -> "EventChanges":
+        """
+            Compare two UID -> hash mappings.
+        """
+        return cls(new.keys() - old.keys(), {uid for uid in new.keys() & old.keys() if new[uid] != old[uid]},
+                   old.keys() - new.keys())
+
+    @property
+    def uids(self) -> set[str]:
+        return self.added | self.changed | self.removed
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(added={self.added!r}, changed={self.changed!r}, removed={self.removed!r})"
+
+
+class IncrementalParser:
+    """
+        Parses successive versions of one feed into `ParsedFeed`s (for `ICSCache.parse`), reusing the events whose
+        VEVENT blocks haven't changed since the last version.
+    """
+    series: str
+    fast: bool
+
+    def __init__(self, series: str = "", fast: bool = False):
+        self.series = series
+        self.fast = fast
+        self._lock = threading.Lock()
+        self._preamble_hash: bytes | None = None
+        # Block hash -> event, from the last parse.
+        self._events: dict[bytes, F1Event] = {}
+
+    def __call__(self, raw: bytes) -> ParsedFeed:
+        chunks = [m.group() for m in VEVENT_PATTERN.finditer(raw)]
+        preamble = VEVENT_PATTERN.sub(b"", raw)
+        if END_CALENDAR not in preamble:
+            raise ValueError("Not an ICS calendar: no END:VCALENDAR")
+        hashes = [chunk_hash(chunk) for chunk in chunks]
+        preamble_hash = chunk_hash(preamble)
+
+        with self._lock:
+            known = self._events if preamble_hash == self._preamble_hash else {}
+            new = {h: chunk for h, chunk in zip(hashes, chunks) if h not in known}
+            parsed = dict(zip(new, self._parse(preamble, list(new.values()))))
+
+            events = {}
+            for h in hashes:
+                events[h] = known[h] if h in known else parsed[h]
+            self._events = events
+            self._preamble_hash = preamble_hash
+
+        print(f"Parsed {len(new)} of {len(chunks)} events{f' for {self.series}' if self.series else ''}")
+        # Events without a UID are keyed by identity, as in `EventIndex.from_feeds`.
+        by_uid = {event.uid or str(id(event)): h for h, event in events.items()}
+        return ParsedFeed([events[h] for h in hashes], by_uid, len(new))
+
+    def _parse(self, preamble: bytes, chunks: list[bytes]) -> list[F1Event]:
+        if not chunks:
+            return []
+        if self.fast:
+            try:
+                return list(fast_ics.iter_events(b"".join(chunks), self.series))
+            except fast_ics.Unsupported as e:
+                print(f"Falling back to icalendar: {e}")
+        # Parse the new blocks in the context of everything else in the calendar (e.g. its VTIMEZONEs).
+        end = preamble.rindex(END_CALENDAR)
+        calendar = icalendar.Calendar.from_ical(preamble[:end] + b"".join(chunks) + preamble[end:])
+        events = [F1Event.from_ical(ev, self.series) for ev in calendar.walk("VEVENT")]
+        if len(events) != len(chunks):
+            raise ValueError(f"Expected {len(chunks)} events, but parsed {len(events)}")
+        return events
@@ -0,0 +1,44 @@
+"""
+    Background thread that keeps a cached feed (and anything derived from it) fresh, so that request threads never
+    have to wait on the upstream.
+"""
+
+import threading
+import time
+from typing import Callable
+
+__all__ = ["Refresher"]
+
+
+class Refresher(threading.Thread):
+    """
+        Calls `refresh` every `interval` seconds (or `retry_interval` after a failure) until stopped.
+        `refresh` should do the network fetch *and* any re-parsing, so the results are ready before a request needs
+        them.
+    """
+    refresh: Callable[[], object]
+    interval: float
+    retry_interval: float
+
+    def __init__(self, refresh: Callable[[], object], interval: float, retry_interval: float):
+        super().__init__(name="f1cal-refresher", daemon=True)
+        self.refresh = refresh
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            start = time.monotonic()
+            try:
+                self.refresh()
+                delay = self.interval
+            except Exception as e:
+                # Keep the thread alive; the caches are still serving whatever they had.
+                print(f"Warning: background refresh failed: {e!r}")
+                delay = self.retry_interval
+            print(f"Background refresh took {time.monotonic() - start:.2f}s; next in {delay:.0f}s")
+            self._stop_event.wait(delay)
+
+    def stop(self):
+        self._stop_event.set()
@@ -1,47 +1,370 @@
 """
     Interfacing with https://github.com/sportstimes/f1 (available at https://f1calendar.com/)
+
+    Any number of ICS feeds can be configured (e.g. sprints, qualifying, feeder series), each tagged with its series.
+    They're fetched in parallel over one pooled `requests.Session`, so refreshing them all takes about as long as the
+    slowest one, and merged into a single event index.
+
+    Feeds are parsed incrementally (see `incremental`), and when the index is rebuilt, the UIDs of the events that
+    were added, changed or removed go to the `on_change` listeners, e.g. to drop just the images that showed them.
+
+    Each rebuilt index is also saved as a binary snapshot (see `snapshot`) next to the cached feeds. A new process can
+    `load_snapshot()` and serve from it within milliseconds of starting, while the feeds are parsed and refreshed in
+    the background; render workers follow the server's snapshots instead of parsing the feeds at all.
 """
 
-import icalendar
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt, timezone as tz
+from typing import TYPE_CHECKING, Callable
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from .. import clock, metrics
 
-__all__ = ["get_next_grand_prix", "get_all_upcoming_grands_prix"]
+from .events import EventIndex, F1Event
+from . import snapshot
+from .ics_cache import DEFAULT_CACHE_DIR, FetchError, ICSCache
+from .incremental import EventChanges, IncrementalParser, ParsedFeed
+from .refresher import Refresher
 
-# This URL doesn't include Sprint races; will need to update to handle that.
+if TYPE_CHECKING:
+    import httpx
+
+__all__ = ["get_next_grand_prix", "get_all_upcoming_grands_prix", "configure", "parse_feed", "on_change",
+           "load_snapshot"]
+
+# This URL doesn't include Sprint races; add the sprint feed (f1-calendar_sprint.ics) to get them.
 URL = "https://files-f1.motorsportcalendars.com/f1-calendar_gp.ics"
 
+# (series, URL) pairs. F1CAL_FEEDS overrides this with whitespace-separated SERIES=URL entries (if it has any).
+DEFAULT_FEEDS = [("F1", URL)]
+
+# What counts as a grand prix for `get_next_grand_prix`, whatever other feeds are merged in.
+GRAND_PRIX_SERIES = "F1"
+GRAND_PRIX_SESSION = "Grand Prix"
+
+# Replaced in feed names, which name files.
+UNSAFE_FILENAME_CHARACTERS = re.compile(r"[^0-9A-Za-z_.-]")
+
+# (series, cache) for each feed, in order of precedence when feeds share events.
+feeds: list[tuple[str, ICSCache[ParsedFeed]]] = []
+session: requests.Session | None = None
+# Whether feeds are parsed with `fast_ics` rather than `icalendar`. F1CAL_FAST_ICS=1 turns it on.
+fast_parser = False
+
+SNAPSHOT_PATH = os.path.join(DEFAULT_CACHE_DIR, "schedule.snapshot")
+# Whether to write a snapshot whenever the index is rebuilt (render workers leave that to the server).
+save_snapshots = True
+
+# (versions of the feeds' calendars, index, hash of each event by UID), swapped as a unit. The versions are None for an
+# index loaded from a snapshot.
+_index: tuple[tuple[int, ...] | None, EventIndex, dict[str, bytes]] | None = None
+_index_lock = threading.Lock()
+# Modification time of the snapshot `_index` was loaded from.
+_snapshot_mtime: int | None = None
+
+_change_listeners: list[Callable[[EventChanges], None]] = []
+
+
+def parse_feed(spec: str) -> tuple[str, str]:
+    """
+        Parse "SERIES=URL" (e.g. "F2=https://.../f2-calendar.ics") into (series, URL).
+    """
+    series, sep, url = spec.partition("=")
+    if not sep or not series or not url:
+        raise ValueError(f"Expected SERIES=URL, got {spec!r}")
+    return series, url
+
+
+def configure(feed_specs: list[tuple[str, str]], fast: bool = False):
+    """
+        Replace the configured feeds with (series, URL) pairs. Feeds share a connection pool sized to fetch them all
+        at once; each has its own on-disk cache (see `feed_name`). With `fast`, they're parsed with `fast_ics`.
+        Raises ValueError if there are none.
+    """
+    global feeds, session, fast_parser, _index, _snapshot_mtime
+
+    if not feed_specs:
+        raise ValueError("No calendar feeds configured")
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=len(feed_specs), pool_maxsize=len(feed_specs))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    feeds = [(series, ICSCache(url, feed_name(series, url), session=session, parse=IncrementalParser(series, fast)))
+             for series, url in feed_specs]
+    fast_parser = fast
+    _index = None
+    _snapshot_mtime = None
+
+
+def feed_name(series: str, url: str) -> str:
+    """
+        What a feed's on-disk cache is called: its series, the file in its URL, and a short hash of the whole URL, so
+        that feeds whose URLs end the same way (e.g. .../f2/calendar.ics and .../f3/calendar.ics) don't share one.
+    """
+    name, _ = os.path.splitext(os.path.basename(urlsplit(url).path))
+    url_hash = hashlib.blake2b(url.encode(), digest_size=4).hexdigest()
+    return UNSAFE_FILENAME_CHARACTERS.sub("_", f"{series}-{name or 'calendar'}-{url_hash}")
+
+
+def feed_config() -> list[tuple[str, str]]:
+    """
+        The configured feeds, as (series, URL) pairs for `configure`.
+    """
+    return [(series, cache.url) for series, cache in feeds]
+
+
+def on_change(listener: Callable[[EventChanges], None]):
+    """
+        Call `listener` with the events that changed whenever the index is rebuilt (but not when it's first built).
+    """
+    _change_listeners.append(listener)
+
+
+def fetch_ics() -> list[tuple[str, ParsedFeed]]:
+    """
+        Return each feed's events, as (series, events), from the cache; feeds are only fetched if they're stale.
+        Feeds that are neither cached nor reachable are left out. Raises `ics_cache.FetchError` if that's all of them.
+    """
+    return _calendars()[1]
+
+
+def _calendars() -> tuple[tuple[int, ...], list[tuple[str, ParsedFeed]]]:
+    versions = []
+    calendars = []
+    for series, cache in feeds:
+        try:
+            version, ics = cache.get_versioned()
+        except FetchError:
+            versions.append(0)
+            continue
+        versions.append(version)
+        calendars.append((series, ics))
+
+    if not calendars:
+        raise FetchError(f"None of the {len(feeds)} calendar feeds could be fetched, and none are cached")
+    return tuple(versions), calendars
+
+
+def get_event_index() -> EventIndex:
+    """
+        Return the merged event index for the current calendars, rebuilding it only when one of them has changed.
+    """
+    global _index
+
+    current = _index
+    if current is not None and current[0] is None and not _feeds_loaded():
+        # From a snapshot, and no feed has been loaded since: that's as good as it gets until one is.
+        return current[1]
+
+    versions, _ = _calendars()
+    current = _index
+    if current is None or current[0] != versions:
+        # Only one thread builds each version; the rest wait for it.
+        with _index_lock:
+            versions, calendars = _calendars()
+            current = _index
+            if current is None or current[0] != versions:
+                if len(calendars) < len(feeds):
+                    print(f"Warning: building the event index from {len(calendars)} of {len(feeds)} feeds")
+                index = EventIndex.from_feeds(parsed.events for _, parsed in calendars)
+                # First feed wins, as for the events themselves.
+                hashes = {}
+                for _, parsed in calendars:
+                    for uid, h in parsed.hashes.items():
+                        hashes.setdefault(uid, h)
+                if save_snapshots:
+                    _save_snapshot(index, hashes)
+                previous, current = current, (versions, index, hashes)
+                _index = current
+
+                if previous is not None:
+                    _changed(EventChanges.between(previous[2], hashes))
+
+    return current[1]
+
+
+def _feeds_loaded() -> bool:
+    return any(cache.version for _, cache in feeds)
+
+
+def _save_snapshot(index: EventIndex, hashes: dict[str, bytes]):
+    try:
+        snapshot.save(SNAPSHOT_PATH, index, hashes, snapshot.config_hash(feed_config()))
+    except OSError as e:
+        print(f"Warning: couldn't write {SNAPSHOT_PATH}: {e}")
+
+
+def load_snapshot() -> bool:
+    """
+        Load the index from the snapshot saved for the configured feeds, if there is one. Until a feed has been loaded
+        (e.g. by the refresher), `get_event_index` serves it as it is. Returns True if a snapshot was loaded.
+    """
+    global _index, _snapshot_mtime
+
+    start = time.perf_counter()
+    try:
+        mtime = os.stat(SNAPSHOT_PATH).st_mtime_ns
+        loaded = snapshot.load(SNAPSHOT_PATH, snapshot.config_hash(feed_config()))
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError) as e:
+        print(f"No usable snapshot at {SNAPSHOT_PATH}: {e}")
+        return False
+    if loaded is None:
+        print(f"Ignoring {SNAPSHOT_PATH}: it's from another version, or for other feeds")
+        return False
+
+    index, hashes = loaded
+    with _index_lock:
+        previous = _index
+        _index = (None, index, hashes)
+        _snapshot_mtime = mtime
+    print(f"Loaded {len(index.events)} events from {SNAPSHOT_PATH} in {(time.perf_counter() - start) * 1000:.1f}ms")
+    if previous is not None:
+        _changed(EventChanges.between(previous[2], hashes))
+    return True
+
+
+def _changed(changes: EventChanges):
+    if not changes:
+        return
+    print(f"Schedule updated: {len(changes.added)} added, {len(changes.changed)} changed, "
+          f"{len(changes.removed)} removed")
+    for listener in _change_listeners:
+        try:
+            listener(changes)
+        except Exception as e:
+            print(f"Warning: schedule change listener {listener!r} failed: {e!r}")
+
+
+def refresh():
+    """
+        Re-fetch all the calendars (in parallel) and rebuild the index, so that it's ready before any request asks for
+        it. Raises `ics_cache.FetchError` if there's nothing to build it from.
+    """
+    with ThreadPoolExecutor(max_workers=len(feeds), thread_name_prefix="f1cal-fetch") as executor:
+        results = list(executor.map(_refresh_feed, (cache for _, cache in feeds)))
+    _report_failures(results)
+    get_event_index()
+
+
+def _refresh_feed(cache: ICSCache) -> Exception | None:
+    try:
+        cache.refresh()
+    except FetchError as e:
+        return e
+    return None
+
+
+async def refresh_async(client: "httpx.AsyncClient"):
+    """
+        As `refresh()`, but for an event loop: the fetches don't block, and rebuilding the index happens in the loop's
+        default executor.
+    """
+    results = await asyncio.gather(*(cache.refresh_async(client) for _, cache in feeds), return_exceptions=True)
+    _report_failures([result if isinstance(result, FetchError) else None for result in results])
+    await asyncio.get_running_loop().run_in_executor(None, get_event_index)
+
+
+def _report_failures(results: list[Exception | None]):
+    for (series, cache), error in zip(feeds, results):
+        if error is not None:
+            print(f"Warning: no {series} calendar from {cache.url}: {error}")
+
+
+def set_background(background: bool = True):
+    """
+        Set whether something other than requests (e.g. a `Refresher`) is responsible for refreshing the feeds.
+    """
+    for _, cache in feeds:
+        cache.background = background
+
+
+def set_offline(offline: bool = True):
+    """
+        Set whether the feeds are only ever read from their on-disk caches (e.g. in a render worker, which leaves
+        fetching them to the server).
+    """
+    for _, cache in feeds:
+        cache.offline = offline
+
+
+def load_disk():
+    """
+        Load every feed from its on-disk cache, without going to the network.
+    """
+    for _, cache in feeds:
+        cache.load_disk()
+
+
+def reload_if_changed():
+    """
+        Reload any feed whose on-disk copy has been replaced (e.g. by the server process, for a render worker). When
+        running from a snapshot, reload that instead, if it has been replaced.
+    """
+    if _snapshot_mtime is not None and not _feeds_loaded():
+        try:
+            mtime = os.stat(SNAPSHOT_PATH).st_mtime_ns
+        except OSError:
+            return
+        if mtime != _snapshot_mtime:
+            load_snapshot()
+        return
+
+    for _, cache in feeds:
+        cache.reload_if_changed()
 
-# TODO: add cached ICS from filesystem.
 
-def fetch_ics() -> icalendar.Calendar:
-    # Fetch the URL
-    res = requests.get(URL)
-    # Decode the ICS
+def start_refresher() -> Refresher:
+    """
+        Hand refreshing over to a background thread. From then on, requests are served from memory (possibly stale)
+        and never wait on the network, except to fetch the calendars for the very first time.
+    """
+    set_background()
+    refresher = Refresher(refresh, interval=min(cache.ttl for _, cache in feeds),
+                          retry_interval=min(cache.retry_interval for _, cache in feeds))
+    refresher.start()
+    return refresher
 
-    # TODO: check response code?
-    # otherwise throw an exception so the caller can say "data unavailable" or something
 
-    ics = icalendar.Calendar.from_ical(res.content)
+def is_grand_prix(event: F1Event) -> bool:
+    return event.series == GRAND_PRIX_SERIES and event.session == GRAND_PRIX_SESSION
 
-    return ics
 
+def get_next_grand_prix(now: float | None = None) -> F1Event | None:
+    """
+        The next grand prix to start after `now` (epoch seconds, defaulting to the current time).
+    """
+    if now is None:
+        now = clock.now()
 
-def get_next_grand_prix() -> icalendar.Event:
-    ics = fetch_ics()  # TODO: use cached ICS or pass by parameter.
+    with metrics.timer("index"):
+        return get_event_index().next_after(now, is_grand_prix)
 
-    # TODO: this isn't correct; need to filter only events in the future(ish)
-    all_events = sorted(ics.events, key=lambda ev: ev.DTSTART)
-    nextgp = next(iter(all_events))
 
-    return nextgp
+def get_all_upcoming_grands_prix(now: float | None = None, until: float | None = None) -> list[F1Event]:
+    """
+        All grands prix starting between `now` and `until`, which defaults to the end of the current calendar year.
+    """
+    if now is None:
+        now = clock.now()
+    if until is None:
+        until = dt(dt.fromtimestamp(now, tz.utc).year + 1, 1, 1, tzinfo=tz.utc).timestamp()
 
-    # Find the next Event that isn't in the past
-    # Depending on how convenient the `icalendar` object is to work with, we could define a new object
-    # to deal with F1 events.
+    with metrics.timer("index"):
+        return get_event_index().between(now, until, is_grand_prix)
 
 
-def get_all_upcoming_grands_prix():
-    ...
-    # Probably need to define some logic for whether we're interested in this season or next season
-    # For now, can return all the Events between now and the end of the calendar year.
+configure([parse_feed(spec) for spec in os.environ.get("F1CAL_FEEDS", "").split()] or DEFAULT_FEEDS,
+          fast=os.environ.get("F1CAL_FAST_ICS", "") not in ("", "0"))
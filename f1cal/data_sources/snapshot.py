@@ -0,0 +1,90 @@
+"""
+    Compact binary snapshots of the merged event index, so that a new process can answer straight away instead of
+    parsing the feeds first.
+
+    A snapshot is a header, then one fixed-size record per event (in start order), then a table of the UTF-8 strings
+    the records point into (each distinct string once). Loading maps the file and unpacks the records in place.
+"""
+
+import hashlib
+import mmap
+import struct
+
+from .events import EventIndex, F1Event
+from .ics_cache import write_atomic
+
+__all__ = ["save", "load", "config_hash", "SNAPSHOT_VERSION"]
+
+# magic, format version, (padding), number of events, hash of the feed configuration, string table offset and size.
+HEADER = struct.Struct(">4sH2xI16sII")
+MAGIC = b"F1SS"
+SNAPSHOT_VERSION = 1
+# start, end, hash of the event's VEVENT block, then (offset, length) in the string table of each of STRING_FIELDS.
+STRING_FIELDS = ("uid", "summary", "location", "session", "series")
+RECORD = struct.Struct(">qq16s" + "II" * len(STRING_FIELDS))
+
+
+def config_hash(feeds: list[tuple[str, str]]) -> bytes:
+    """
+        Identifies a feed configuration, so that a snapshot is only used with the feeds it was made from.
+    """
+    return hashlib.blake2b(repr(feeds).encode(), digest_size=16).digest()
+
+
+def save(path: str, index: EventIndex, hashes: dict[str, bytes], config: bytes):
+    """
+        Write `index` (and each event's block hash, by UID) to `path`, atomically.
+    """
+    strings = bytearray()
+    offsets: dict[str, tuple[int, int]] = {}
+
+    def string(s: str) -> tuple[int, int]:
+        if s not in offsets:
+            encoded = s.encode()
+            offsets[s] = (len(strings), len(encoded))
+            strings.extend(encoded)
+        return offsets[s]
+
+    records = bytearray()
+    for event in index.events:
+        refs = [part for name in STRING_FIELDS for part in string(getattr(event, name))]
+        records += RECORD.pack(event.start, event.end, hashes.get(event.uid or str(id(event)), bytes(16)), *refs)
+
+    header = HEADER.pack(MAGIC, SNAPSHOT_VERSION, len(index.events), config, HEADER.size + len(records), len(strings))
+    write_atomic(path, header + records + strings)
+
+
+def load(path: str, config: bytes) -> tuple[EventIndex, dict[str, bytes]] | None:
+    """
+        Read a snapshot written by `save`. Returns None if it's for another version of the format or other feeds.
+        Raises OSError if it can't be read, and ValueError if it's corrupt.
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, memoryview(m) as view:
+        try:
+            magic, version, count, snapshot_config, strings_at, strings_size = HEADER.unpack_from(view)
+        except struct.error as e:
+            raise ValueError(f"Truncated snapshot header: {e}") from e
+        if magic != MAGIC:
+            raise ValueError(f"Not a schedule snapshot: {magic!r}")
+        if version != SNAPSHOT_VERSION or snapshot_config != config:
+            return None
+        if strings_at != HEADER.size + count * RECORD.size or strings_at + strings_size != len(view):
+            raise ValueError("Snapshot size doesn't match its header")
+
+        # Decode each distinct string once, so equal fields share one object (as they would from the parser's cache).
+        decoded: dict[tuple[int, int], str] = {}
+
+        def string(offset: int, length: int) -> str:
+            if (s := decoded.get((offset, length))) is None:
+                s = decoded[offset, length] = str(view[strings_at + offset:strings_at + offset + length], "utf-8")
+            return s
+
+        events = []
+        hashes = {}
+        for start, end, block_hash, *refs in RECORD.iter_unpack(view[HEADER.size:strings_at]):
+            uid, summary, location, session, series = (string(refs[i], refs[i + 1]) for i in range(0, len(refs), 2))
+            event = F1Event(uid, summary, location, start, end, session, series)
+            events.append(event)
+            hashes[uid or str(id(event))] = block_hash
+
+    return EventIndex(events), hashes
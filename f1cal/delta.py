@@ -0,0 +1,101 @@
+"""
+    Dirty-region updates between two raw framebuffers (see `encoders.RAW_HEADER`).
+
+    A delta is a header, then a list of rectangles, each followed by its packed rows. The rectangles are bands of
+    changed rows, narrowed to the bytes that changed within the band, so the size of a delta scales with how much of
+    the screen changed rather than with the size of the screen.
+"""
+
+import struct
+import zlib
+
+from . import metrics
+from .caching import LRUCache
+from .encoders import RAW_COMPRESSION_NONE, RAW_COMPRESSION_ZLIB, RAW_HEADER, RAW_MAGIC
+
+__all__ = ["framebuffers", "encode_delta", "DELTA_HEADER", "DELTA_RECT"]
+
+# magic, version, bits per pixel, compression, (padding), width, height, bytes per row, number of rectangles.
+DELTA_HEADER = struct.Struct(">4sBBBxHHHH")
+DELTA_MAGIC = b"F1DL"
+DELTA_VERSION = 1
+# x (in bytes, i.e. pixel pairs), y, width (in bytes), height
+DELTA_RECT = struct.Struct(">HHHH")
+
+# Changed rows separated by fewer unchanged rows than this are sent as one rectangle: resending a few unchanged
+# rows can be cheaper than the header of a second rectangle.
+MERGE_GAP = 4
+
+# Recent raw framebuffers, by ETag, for the clients that might come asking for a delta against them.
+FRAMEBUFFER_CACHE_SIZE = 64
+framebuffers: LRUCache[bytes] = LRUCache(FRAMEBUFFER_CACHE_SIZE)
+metrics.register_cache("framebuffers", framebuffers)
+
+
+def unpack_raw(raw: bytes) -> tuple[tuple, bytes]:
+    """
+        Split a raw framebuffer into its header fields and its (uncompressed) rows.
+    """
+    fields = RAW_HEADER.unpack_from(raw)
+    magic, version, bits, compression, width, height, stride = fields
+    if magic != RAW_MAGIC:
+        raise ValueError(f"Not a raw framebuffer: {magic!r}")
+
+    payload = raw[RAW_HEADER.size:]
+    if compression == RAW_COMPRESSION_ZLIB:
+        payload = zlib.decompress(payload)
+    return fields, payload
+
+
+def dirty_rects(old: bytes, new: bytes, stride: int, height: int) -> list[tuple[int, int, int, int]]:
+    """
+        Rectangles (x, y, w, h), in bytes and rows, covering every byte that differs between `old` and `new`.
+    """
+    rects = []
+    band = None  # [first byte, first row, last byte, last row]
+
+    for y in range(height):
+        old_row = old[y * stride:(y + 1) * stride]
+        new_row = new[y * stride:(y + 1) * stride]
+        if old_row == new_row:
+            continue
+
+        # The XOR of the rows is only non-zero where they differ, so its highest and lowest set bits give the range.
+        diff = int.from_bytes(old_row, "big") ^ int.from_bytes(new_row, "big")
+        first = stride - 1 - (diff.bit_length() - 1) // 8
+        last = stride - 1 - ((diff & -diff).bit_length() - 1) // 8
+
+        if band is not None and y - band[3] <= MERGE_GAP:
+            band = [min(band[0], first), band[1], max(band[2], last), y]
+        else:
+            if band is not None:
+                rects.append((band[0], band[1], band[2] - band[0] + 1, band[3] - band[1] + 1))
+            band = [first, y, last, y]
+
+    if band is not None:
+        rects.append((band[0], band[1], band[2] - band[0] + 1, band[3] - band[1] + 1))
+    return rects
+
+
+def encode_delta(base: bytes, current: bytes, compress: bool = True) -> bytes:
+    """
+        Encode the changes from raw framebuffer `base` to raw framebuffer `current`.
+    """
+    (_, _, bits, _, width, height, stride), old = unpack_raw(base)
+    (_, _, new_bits, _, new_width, new_height, _), new = unpack_raw(current)
+    if (bits, width, height) != (new_bits, new_width, new_height):
+        raise ValueError("Framebuffers have different formats")
+
+    rects = dirty_rects(old, new, stride, height)
+
+    parts = []
+    for x, y, w, h in rects:
+        parts.append(DELTA_RECT.pack(x, y, w, h))
+        parts.extend(new[row * stride + x:row * stride + x + w] for row in range(y, y + h))
+    payload = b"".join(parts)
+
+    compression = RAW_COMPRESSION_NONE
+    if compress:
+        compression, payload = RAW_COMPRESSION_ZLIB, zlib.compress(payload, 9)
+
+    return DELTA_HEADER.pack(DELTA_MAGIC, DELTA_VERSION, bits, compression, width, height, stride, len(rects)) + payload
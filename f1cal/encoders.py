@@ -0,0 +1,178 @@
+"""
+    Image encoders for palette images.
+
+    `IndexedEncoder` writes PNG and BMP directly rather than through Pillow. The palette is truncated to the colours
+    the display actually has, and pixels are packed at the smallest bit depth that holds them (Pillow's BMP writer
+    always uses 8 bits and 256 colours). PNG scanlines are left unfiltered, which is cheapest for the frame's
+    decoder, and the zlib level and strategy are configurable: `Z_RLE` is fastest on flat fills, but the default
+    strategy also finds the repeats between rows, so compresses our layouts better.
+
+    `?format=raw` is our own format: the palette indices packed 4 bits per pixel, deflated by default (see
+    `RAW_HEADER`). The frame inflates it as it downloads and, in the common case that PicoGraphics' framebuffer isn't
+    exposed in that layout (the 7.3" frame keeps it in PSRAM), draws each row as runs of one colour with
+    `pixel_span`. That's still cheaper than decoding a PNG, and the same rows can be patched by deltas (see `delta`).
+"""
+
+import struct
+import typing
+import zlib
+from io import BytesIO
+
+from PIL import Image
+
+from .palettes import Palette
+
+__all__ = ["Encoder", "PillowEncoder", "IndexedEncoder", "CONTENT_TYPES", "RAW_HEADER"]
+
+ImageFormat = typing.Literal['png', 'bmp', 'raw']
+
+CONTENT_TYPES: dict[str, str] = {
+    'png': "image/png",
+    'bmp': "image/bmp",
+    'raw': "application/octet-stream",
+    # Not an encoder format: serve_image builds deltas out of raw framebuffers.
+    'delta': "application/octet-stream",
+}
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COLOUR_TYPE_PALETTE = 3
+
+# Bit depths allowed for PNG palette images. BMP allows the same, except 2.
+PNG_BIT_DEPTHS = (1, 2, 4, 8)
+BMP_BIT_DEPTHS = (1, 4, 8)
+
+# Raw framebuffer: magic, version, bits per pixel, compression, (padding), width, height, bytes per row; then the
+# packed rows. The rows are in PicoGraphics' 4-bit layout (two pixels per byte, first pixel in the high nibble, rows
+# unpadded for even widths): a frame that exposes a framebuffer in that layout can read them straight into it, and
+# others draw them a run of pixels at a time.
+RAW_HEADER = struct.Struct(">4sBBBxHHH")
+RAW_MAGIC = b"F1FB"
+RAW_VERSION = 1
+RAW_BIT_DEPTHS = (4,)
+RAW_COMPRESSION_NONE = 0
+# A zlib stream, which the frame inflates as it reads with MicroPython's `deflate.DeflateIO`.
+RAW_COMPRESSION_ZLIB = 1
+
+
+class Encoder(typing.Protocol):
+    def encode(self, img: Image.Image, imgformat: ImageFormat, palette: type[Palette]) -> bytes:
+        ...
+
+
+class PillowEncoder:
+    """
+        Pillow's own PNG/BMP writers.
+    """
+
+    def encode(self, img: Image.Image, imgformat: ImageFormat, palette: type[Palette]) -> bytes:
+        # https://stackoverflow.com/a/10170635
+        img_io = BytesIO()
+        if imgformat == 'png':
+            img.save(img_io, format='PNG', optimize=True, bits=palette.palette_bits())
+        elif imgformat == 'bmp':
+            img.save(img_io, format='BMP', optimize=True, bits=palette.palette_bits())
+        return img_io.getvalue()
+
+
+class IndexedEncoder:
+    """
+        Writes palette images with a truncated palette, packed at the palette's bit depth.
+    """
+    level: int
+    strategy: int
+    # Whether to deflate raw framebuffers. Uncompressed, they're ~100x bigger than the PNG.
+    compress_raw: bool
+
+    def __init__(self, level: int = 9, strategy: int = zlib.Z_DEFAULT_STRATEGY, compress_raw: bool = True):
+        self.level = level
+        self.strategy = strategy
+        self.compress_raw = compress_raw
+
+    def encode(self, img: Image.Image, imgformat: ImageFormat, palette: type[Palette]) -> bytes:
+        if imgformat == 'png':
+            return self.encode_png(img, palette)
+        elif imgformat == 'bmp':
+            return self.encode_bmp(img, palette)
+        elif imgformat == 'raw':
+            return self.encode_raw(img, palette)
+        raise ValueError(f"Unsupported format {imgformat!r}")
+
+    def encode_png(self, img: Image.Image, palette: type[Palette]) -> bytes:
+        bits = bit_depth(palette, PNG_BIT_DEPTHS)
+        width, height = img.size
+        rows = pack_rows(img, bits)
+        stride = len(rows) // height
+
+        # Every scanline starts with its filter type, left as 0 ("none"): with large flat areas, it does as well as any.
+        scanlines = bytearray((stride + 1) * height)
+        for y in range(height):
+            scanlines[y * (stride + 1) + 1:(y + 1) * (stride + 1)] = rows[y * stride:(y + 1) * stride]
+
+        idat = self.deflate(scanlines)
+
+        plte = bytes(channel for colour in palette for channel in colour.to_rgb())
+
+        return b"".join((
+            PNG_SIGNATURE,
+            png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, bits, PNG_COLOUR_TYPE_PALETTE, 0, 0, 0)),
+            png_chunk(b"PLTE", plte),
+            png_chunk(b"IDAT", idat),
+            png_chunk(b"IEND", b""),
+        ))
+
+    def encode_bmp(self, img: Image.Image, palette: type[Palette]) -> bytes:
+        bits = bit_depth(palette, BMP_BIT_DEPTHS)
+        width, height = img.size
+        rows = pack_rows(img, bits)
+        stride = len(rows) // height
+        # BMP rows are padded to 4 bytes, and stored bottom-up.
+        padded_stride = (stride + 3) & ~3
+
+        pixels = bytearray(padded_stride * height)
+        for y in range(height):
+            offset = (height - 1 - y) * padded_stride
+            pixels[offset:offset + stride] = rows[y * stride:(y + 1) * stride]
+
+        colours = b"".join(bytes((b, g, r, 0)) for r, g, b in (colour.to_rgb() for colour in palette))
+
+        header_size = 14 + 40
+        data_offset = header_size + len(colours)
+        return b"".join((
+            struct.pack("<2sIHHI", b"BM", data_offset + len(pixels), 0, 0, data_offset),
+            struct.pack("<IiiHHIIiiII", 40, width, height, 1, bits, 0, len(pixels), 2835, 2835, len(palette),
+                        len(palette)),
+            colours,
+            pixels,
+        ))
+
+    def encode_raw(self, img: Image.Image, palette: type[Palette]) -> bytes:
+        bits = bit_depth(palette, RAW_BIT_DEPTHS)
+        width, height = img.size
+        rows = pack_rows(img, bits)
+        if self.compress_raw:
+            compression, payload = RAW_COMPRESSION_ZLIB, self.deflate(rows)
+        else:
+            compression, payload = RAW_COMPRESSION_NONE, rows
+        return RAW_HEADER.pack(RAW_MAGIC, RAW_VERSION, bits, compression, width, height, len(rows) // height) + payload
+
+    def deflate(self, data: bytes) -> bytes:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS, 9, self.strategy)
+        return compressor.compress(data) + compressor.flush()
+
+
+def bit_depth(palette: type[Palette], allowed: tuple[int, ...]) -> int:
+    bits = palette.palette_bits()
+    return next(depth for depth in allowed if depth >= bits)
+
+
+def pack_rows(img: Image.Image, bits: int) -> bytes:
+    """
+        Pixel indices packed `bits` to a byte (first pixel in the most significant bits), each row padded to a byte.
+    """
+    if bits == 8:
+        return img.tobytes("raw", "P")
+    return img.tobytes("raw", f"P;{bits}")
+
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
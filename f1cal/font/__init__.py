@@ -1,18 +1,48 @@
+import functools
 import os.path
+from io import BytesIO
 
 from PIL import ImageFont
 from typing import Callable
 
+from .. import metrics
+from ..caching import LRUCache
+
+# Each distinct (face, size) is a FreeType face of its own, so keep the ones layouts actually use.
+FONT_CACHE_SIZE = 64
+font_cache: LRUCache[ImageFont.FreeTypeFont] = LRUCache(FONT_CACHE_SIZE)
+metrics.register_cache("fonts", font_cache)
+
+# Every file handed to `load_otf`, for `preload`.
+font_paths: list[str] = []
+
+
+@functools.cache
+def read_font_file(path: str) -> bytes:
+    # Read each file once; BytesIO hands the same bytes object to every face made from it.
+    with open(path, "rb") as f:
+        return f.read()
+
 
 def load_otf(filename: str) -> Callable[[any], ImageFont.FreeTypeFont]:
     path = os.path.join(os.path.dirname(__file__), filename)
+    font_paths.append(path)
 
-    def inner(*args, **kwargs):
-        return ImageFont.truetype(path, *args, **kwargs)
+    def inner(size: float, **kwargs):
+        key = (filename, size, tuple(sorted(kwargs.items())))
+        return font_cache.get_or_create(key, lambda: ImageFont.truetype(BytesIO(read_font_file(path)), size, **kwargs))
 
     return inner
 
 
+def preload():
+    """
+        Read every font file up front (e.g. in a new render worker), rather than on first use.
+    """
+    for path in font_paths:
+        read_font_file(path)
+
+
 F1Reg = load_otf("Formula1-Regular.otf")
 F1Bold = load_otf("Formula1-Bold.otf")
 F1Wide = load_otf("Formula1-Wide.otf")
@@ -0,0 +1,179 @@
+"""
+    Per-stage timings and counters, served in the Prometheus text format on /metrics.
+
+    Stages are timed with `timer("draw", route="countdown_inky")` and so on: fetch (the upstream request), parse,
+    index (finding events in the schedule), draw, encode and delta. Only a fraction of timings are taken, set by
+    `sample_rate` (F1CAL_METRICS_SAMPLE, default 1); the rest cost a call to `random.random()`, so it can be left on
+    with a low rate in production. Counters (responses, bytes out, fetch results) and cache hit/miss counts are always
+    exact.
+
+    Render workers (see `render_pool`) time their draws and encodes with `captured()`, and the server `replay()`s them,
+    so /metrics covers the whole pool.
+"""
+
+import contextlib
+import contextvars
+import os
+import random
+import threading
+import time
+from typing import Iterator, Protocol
+
+__all__ = ["timer", "observe", "count", "register_cache", "render", "captured", "replay", "CONTENT_TYPE"]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds of the timing histograms' buckets, in seconds.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Fraction of stage timings to take, from 0 (none) to 1 (all).
+sample_rate = float(os.environ.get("F1CAL_METRICS_SAMPLE", "1"))
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    """
+        Observations of one stage with one set of labels, in cumulative buckets.
+    """
+    counts: list[int]
+    total: float
+    count: int
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+        self.total += seconds
+        self.count += 1
+
+
+class HasHitCounts(Protocol):
+    hits: int
+    misses: int
+
+
+_lock = threading.Lock()
+_histograms: dict[tuple[str, Labels], Histogram] = {}
+_counters: dict[tuple[str, Labels], float] = {}
+_caches: dict[str, HasHitCounts] = {}
+# Where a render worker collects its observations to send back, instead of recording them.
+_capture: contextvars.ContextVar[list | None] = contextvars.ContextVar("capture", default=None)
+
+_NOT_SAMPLED = contextlib.nullcontext()
+
+
+def timer(stage: str, **labels: str) -> contextlib.AbstractContextManager:
+    """
+        Time the `with` block as `stage` (if it's sampled).
+    """
+    if sample_rate <= 0 or (sample_rate < 1 and random.random() >= sample_rate):
+        return _NOT_SAMPLED
+    return _timed(stage, labels)
+
+
+@contextlib.contextmanager
+def _timed(stage: str, labels: dict[str, str]) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, **labels)
+
+
+def observe(stage: str, seconds: float, **labels: str):
+    key = (stage, tuple(sorted(labels.items())))
+    if (capture := _capture.get()) is not None:
+        capture.append(key + (seconds,))
+        return
+    with _lock:
+        if (histogram := _histograms.get(key)) is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+
+def count(name: str, amount: float = 1, **labels: str):
+    """
+        Add `amount` to the counter `f1cal_<name>_total` with these labels.
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def register_cache(name: str, cache: HasHitCounts):
+    """
+        Report `cache`'s hits and misses (e.g. an `LRUCache`'s) as f1cal_cache_hits_total{cache=name}, etc.
+    """
+    _caches[name] = cache
+
+
+@contextlib.contextmanager
+def captured() -> Iterator[list]:
+    """
+        Collect the timings taken in this context into a list (for `replay` in another process), instead of recording
+        them here.
+    """
+    observations = []
+    token = _capture.set(observations)
+    try:
+        yield observations
+    finally:
+        _capture.reset(token)
+
+
+def replay(observations: list):
+    for stage, labels, seconds in observations:
+        observe(stage, seconds, **dict(labels))
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render() -> str:
+    """
+        Everything recorded so far, in the Prometheus text exposition format.
+    """
+    with _lock:
+        histograms = {key: (list(h.counts), h.total, h.count) for key, h in _histograms.items()}
+        counters = dict(_counters)
+
+    lines = [
+        "# HELP f1cal_metrics_sample_rate Fraction of stage timings taken.",
+        "# TYPE f1cal_metrics_sample_rate gauge",
+        f"f1cal_metrics_sample_rate {sample_rate}",
+        "# HELP f1cal_stage_seconds Time spent in each stage (sampled).",
+        "# TYPE f1cal_stage_seconds histogram",
+    ]
+    for (stage, labels), (counts, total, n) in sorted(histograms.items()):
+        labels = (("stage", stage),) + labels
+        for bound, bucket_count in zip(BUCKETS, counts):
+            lines.append(f"f1cal_stage_seconds_bucket{format_labels(labels + (('le', str(bound)),))} {bucket_count}")
+        lines.append(f"f1cal_stage_seconds_bucket{format_labels(labels + (('le', '+Inf'),))} {n}")
+        lines.append(f"f1cal_stage_seconds_sum{format_labels(labels)} {total}")
+        lines.append(f"f1cal_stage_seconds_count{format_labels(labels)} {n}")
+
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE f1cal_{name}_total counter")
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                lines.append(f"f1cal_{name}_total{format_labels(labels)} {value}")
+
+    for kind in ("hits", "misses"):
+        lines.append(f"# TYPE f1cal_cache_{kind}_total counter")
+        for name, cache in sorted(_caches.items()):
+            lines.append(f"f1cal_cache_{kind}_total{format_labels((('cache', name),))} {getattr(cache, kind)}")
+
+    return "\n".join(lines) + "\n"
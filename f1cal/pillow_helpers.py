@@ -1,87 +1,452 @@
 """
     Copied from fridgemagnet project
 """
+import hashlib
+import math
+import threading
 import typing
+import weakref
 from PIL import Image, ImageDraw, ImageFont
-from bottle import request, response
-from io import BytesIO
+from bottle import HTTPResponse, request, response
 from typing import Generator
 
+from . import clock, metrics, render_pool
+from .caching import LRUCache
+from .delta import encode_delta, framebuffers
+from .encoders import CONTENT_TYPES, Encoder, ImageFormat, IndexedEncoder
 from .palettes import Inky as InkyCol, Palette
 
 
+# Word widths per font, kept for as long as the font is (the font loaders cache faces, so that's a while).
+WORD_WIDTH_CACHE_SIZE = 1024
+_word_widths: weakref.WeakKeyDictionary[ImageFont.ImageFont, LRUCache[float]] = weakref.WeakKeyDictionary()
+_word_widths_lock = threading.Lock()
+
+
+def word_width(word: str, draw: ImageDraw.ImageDraw, font: ImageFont.ImageFont) -> float:
+    with _word_widths_lock:
+        if (widths := _word_widths.get(font)) is None:
+            widths = _word_widths[font] = LRUCache(WORD_WIDTH_CACHE_SIZE)
+
+    # The draw's font mode affects hinting, so it's part of the key.
+    return widths.get_or_create((draw.fontmode, word), lambda: draw.textlength(word, font=font))
+
+
 def break_lines(text: str, draw: ImageDraw.ImageDraw, font: ImageFont.ImageFont, width: int) -> Generator[
         str, None, None]:
     """
         Split `str` into multiple strings, such that they all fit within `width` when drawn with `font`.
+
+        Lines are built greedily from (cached) word widths, then measured for real once at the end of each line to
+        correct for kerning, so the result is the same as fitting as many words as possible on each line.
     """
     words = text.split()
+    space = word_width(' ', draw, font)
+
+    start = 0
+    while start < len(words):
+        # Estimate how many words will fit.
+        end = start + 1
+        estimate = word_width(words[start], draw, font)
+        while end < len(words) and (estimate + space + word_width(words[end], draw, font)) <= width:
+            estimate += space + word_width(words[end], draw, font)
+            end += 1
+
+        # Then correct the estimate against the real width of the line.
+        line_width = draw.textlength(' '.join(words[start:end]), font=font)
+        while line_width > width and end > start + 1:
+            end -= 1
+            line_width = draw.textlength(' '.join(words[start:end]), font=font)
+
+        # If we couldn't "fit" any words on, the line has one word anyway, so we don't get stuck.
+        if line_width <= width:
+            while end < len(words) and draw.textlength(' '.join(words[start:end + 1]), font=font) <= width:
+                end += 1
+
+        yield ' '.join(words[start:end])
+        start = end
+
+
+def fit_text(text: str, draw: ImageDraw.ImageDraw, box: tuple[float, float | None],
+             font_family: typing.Callable[[float], ImageFont.FreeTypeFont], max_lines: int | None = None,
+             max_size: float | None = None, min_size: int = 1, spacing: float = 4) -> tuple[
+        ImageFont.FreeTypeFont, list[str]]:
+    """
+        Find the largest font size (up to `max_size`) at which `text` fits within `box` (width, height), wrapped onto
+        at most `max_lines` lines. A height of None means only the width and number of lines matter.
+
+        Returns the font, and the wrapped lines. If nothing fits, returns the layout at `min_size` anyway.
+    """
+    width, height = box
+    if max_size is None:
+        max_size = height if height is not None else width
+
+    # Each candidate size is laid out at most once.
+    layouts: dict[float, tuple[bool, ImageFont.FreeTypeFont, list[str]]] = {}
+
+    def layout(size: float) -> tuple[bool, ImageFont.FreeTypeFont, list[str]]:
+        if size not in layouts:
+            font = font_family(size)
+            lines = list(break_lines(text, draw, font, width))
+            fits = max_lines is None or len(lines) <= max_lines
+            # break_lines will put a word on a line by itself even if it's too wide.
+            fits = fits and all(draw.textlength(line, font=font) <= width for line in lines)
+            if fits and height is not None:
+                bbox = draw.multiline_textbbox((0, 0), '\n'.join(lines), font=font, spacing=spacing)
+                fits = bbox[3] - bbox[1] <= height
+            layouts[size] = (fits, font, lines)
+        return layouts[size]
+
+    # Allow for a non-integer maximum size, which is tried first.
+    fits, font, lines = layout(max_size)
+    if fits:
+        return font, lines
+
+    # Binary search for the largest size that fits, in [lo, hi).
+    lo, hi = min_size, math.ceil(max_size)
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if layout(mid)[0]:
+            lo = mid
+        else:
+            hi = mid
+
+    _, font, lines = layout(lo)
+    return font, lines
+
+
+# Lines of text rasterised by `draw_text`, bounded by count and by the bytes of their masks. Big static strings (like
+# race week's 180pt letters) are most of the time a route spends drawing, and they look the same every time.
+TEXT_BITMAP_CACHE_SIZE = 256
+TEXT_BITMAP_CACHE_BYTES = 8 * 1024 * 1024
+
 
-    while len(words) > 0:
-        # Assume that all the words will fit on one line.
-        line = words.copy()
+class TextBitmap:
+    """
+        A line of text, rasterised: its mask (None if it's empty), where the mask goes relative to the anchor point
+        (in whole pixels), and the text's bounding box relative to the anchor point, as `textbbox` gives it.
+    """
+    mask: Image.Image | None
+    offset: tuple[int, int]
+    bbox: tuple[float, float, float, float]
+
+    def __init__(self, mask: Image.Image | None, offset: tuple[int, int], bbox: tuple[float, float, float, float]):
+        self.mask = mask
+        self.offset = offset
+        self.bbox = bbox
+
+    @property
+    def nbytes(self) -> int:
+        # Pillow keeps "1" and "L" images at a byte per pixel.
+        return 0 if self.mask is None else self.mask.width * self.mask.height
+
+
+text_bitmaps: LRUCache[TextBitmap] = LRUCache(TEXT_BITMAP_CACHE_SIZE, maxweight=TEXT_BITMAP_CACHE_BYTES,
+                                              weigh=lambda bitmap: bitmap.nbytes)
+metrics.register_cache("text_bitmaps", text_bitmaps)
 
-        line_width = draw.textlength(' '.join(line), font=font)
-        while line_width > width:
-            line.pop()
-            line_width = draw.textlength(' '.join(line), font=font)
 
-        if len(line) == 0:
-            # we couldn't "fit" any words on - so put one on anyway, so we don't get stuck.
-            line.append(words.pop(0))
+def rasterise_text(text: str, font: ImageFont.FreeTypeFont, anchor: str, start: tuple[float, float],
+                   fontmode: str) -> TextBitmap:
+    """
+        Rasterise `text` exactly as `ImageDraw.text` does, at a point whose fractional part is `start`.
+    """
+    mask, offset = font.getmask2(text, fontmode, anchor=anchor, start=start)
+    bbox = font.getbbox(text, fontmode, anchor=anchor)
+    if 0 in mask.size:
+        return TextBitmap(None, offset, bbox)
+    # getmask2 hands back Pillow's internal image; wrap it for `ImageDraw.bitmap`.
+    return TextBitmap(Image.Image()._new(mask), offset, bbox)
+
+
+def draw_text(draw: ImageDraw.ImageDraw, xy: tuple[float, float], text: str, font: ImageFont.FreeTypeFont,
+              fill: int, anchor: str | None = None) -> tuple[float, float, float, float]:
+    """
+        `draw.text` for a single line, pasting a cached mask rather than rasterising the text every time. Returns the
+        text's bounding box, as `draw.textbbox` would.
+    """
+    if "\n" in text:
+        draw.text(xy, text, fill=fill, font=font, anchor=anchor)
+        return draw.textbbox(xy, text, font=font, anchor=anchor)
+
+    if anchor is None:
+        anchor = "la"
+    x, y = xy
+    # ImageDraw rasterises at the fractional part of the position, and pastes at the whole part.
+    start = (math.modf(x)[0], math.modf(y)[0])
+    key = (font.getname(), font.size, font.layout_engine, text, anchor, start, draw.fontmode)
+    bitmap = text_bitmaps.get_or_create(key, lambda: rasterise_text(text, font, anchor, start, draw.fontmode))
 
-        # remove the words in `words` that are now also in `line`
-        del words[:len(line)]
-        yield ' '.join(line)
+    if bitmap.mask is not None:
+        draw.bitmap((int(x) + bitmap.offset[0], int(y) + bitmap.offset[1]), bitmap.mask, fill=fill)
+    left, top, right, bottom = bitmap.bbox
+    return left + x, top + y, right + x, bottom + y
 
 
 class EPaperDisplay:
     palette: type[Palette]
     WIDTH: int
     HEIGHT: int
+    encoder: Encoder
 
-    def __init__(self, p: type[Palette], w: int, h: int):
+    def __init__(self, p: type[Palette], w: int, h: int, encoder: Encoder = None):
         self.palette = p
         self.WIDTH = w
         self.HEIGHT = h
+        self.encoder = encoder if encoder is not None else IndexedEncoder()
 
 
 EPD_INKY = EPaperDisplay(InkyCol, 800, 480)
 
 
-def serve_image(route_handler: callable, epd: EPaperDisplay):
+# Encoded images and their ETags, keyed on (route, format, route-declared key).
+# The key is expected to capture everything visible in the image, so the expiry is only a backstop.
+RENDER_CACHE_SIZE = 64
+RENDER_CACHE_TTL = 60 * 60
+render_cache: LRUCache[tuple[bytes, str]] = LRUCache(RENDER_CACHE_SIZE, ttl=RENDER_CACHE_TTL)
+metrics.register_cache("render", render_cache)
+
+# Clients may keep the image, but must check it's still current (If-None-Match) before using it again.
+CACHE_CONTROL = "no-cache"
+
+
+# Deltas are deterministic given the two framebuffers, so are cached on their ETags.
+DELTA_CACHE_SIZE = 64
+deltas: LRUCache[bytes] = LRUCache(DELTA_CACHE_SIZE)
+metrics.register_cache("deltas", deltas)
+
+
+def invalidate_events(uids: set[str]) -> int:
+    """
+        Drop the cached images whose route-declared keys include any of the event UIDs in `uids`.
+    """
+    def mentions(key) -> bool:
+        route_key = key[2] if isinstance(key[2], tuple) else (key[2],)
+        return any(isinstance(part, str) and part in uids for part in route_key)
+
+    return render_cache.discard_where(mentions)
+
+
+def etag_for(data: bytes) -> str:
+    """
+        Strong ETag: a hash of the encoded image itself.
+    """
+    return '"' + hashlib.blake2b(data, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip() for tag in if_none_match.split(","))
+
+
+# What a route declares as its static layers: given the route's arguments (and `epd`), a (hashable) key for how they
+# look, and a function that paints them, e.g. `("countdown", lambda draw, epd: ...)`.
+StaticLayers = typing.Callable[..., tuple[typing.Hashable, typing.Callable[[ImageDraw.ImageDraw, EPaperDisplay], None]]]
+
+# Routes' static layers, painted once and copied for each render; keyed on (route, key the route gave).
+STATIC_LAYER_CACHE_SIZE = 16
+static_layers_cache: LRUCache[Image.Image] = LRUCache(STATIC_LAYER_CACHE_SIZE)
+metrics.register_cache("static_layers", static_layers_cache)
+
+
+def blank_canvas(epd: EPaperDisplay) -> Image.Image:
+    # This depends on the enum having WHITE defined.
+    # noinspection PyUnresolvedReferences
+    img = Image.new("P", (epd.WIDTH, epd.HEIGHT), color=epd.palette.WHITE.value)
+    img.putpalette(epd.palette.to_palette())
+    return img
+
+
+def canvas(route_handler: callable, epd: EPaperDisplay, static_layers: StaticLayers | None, *args,
+           **kwargs) -> Image.Image:
+    """
+        A canvas for the route to draw on: blank, or a copy of its static layers (painted the first time their key is
+        seen).
+    """
+    if static_layers is None:
+        return blank_canvas(epd)
+
+    key, paint = static_layers(*args, epd=epd, **kwargs)
+
+    def create() -> Image.Image:
+        img = blank_canvas(epd)
+        paint(ImageDraw.Draw(img), epd)
+        return img
+
+    return static_layers_cache.get_or_create((route_handler.__name__, key), create).copy()
+
+
+def render(route_handler: callable, epd: EPaperDisplay, imgformat: ImageFormat, *args,
+           static_layers: StaticLayers | None = None, **kwargs) -> bytes:
+    """
+        Draw a route onto a fresh canvas (or a copy of its static layers, if it has them) and encode it.
+    """
+    with metrics.timer("draw", route=route_handler.__name__):
+        img = canvas(route_handler, epd, static_layers, *args, **kwargs)
+        route_handler(ImageDraw.Draw(img), *args, epd=epd, **kwargs)
+
+    with metrics.timer("encode", route=route_handler.__name__, format=imgformat):
+        return epd.encoder.encode(img, imgformat, epd.palette)
+
+
+class ImageRoute:
+    """
+        An image-serving route, as registered by `serve_image`: knows how to render (through the render cache) outside
+        of a request, and, if the route says, when its image will next change.
+    """
+    route_handler: callable
+    epd: EPaperDisplay
+    cache_key: typing.Callable[..., typing.Hashable] | None
+    next_change: typing.Callable[[float], float | None] | None
+    static_layers: StaticLayers | None
+    state: typing.Callable[..., typing.Any] | None
+
+    def __init__(self, route_handler: callable, epd: EPaperDisplay,
+                 cache_key: typing.Callable[..., typing.Hashable] = None,
+                 next_change: typing.Callable[[float], float | None] = None,
+                 static_layers: StaticLayers = None,
+                 state: typing.Callable[..., typing.Any] = None):
+        self.route_handler = route_handler
+        self.epd = epd
+        self.cache_key = cache_key
+        self.next_change = next_change
+        self.static_layers = static_layers
+        self.state = state
+
+    @property
+    def name(self) -> str:
+        return self.route_handler.__name__
+
+    def next_refresh(self) -> int | None:
+        """
+            When a client should next fetch this image, as whole epoch seconds (rounded up, so not before the change).
+        """
+        if self.next_change is None:
+            return None
+        t = self.next_change(clock.now())
+        return None if t is None else math.ceil(t)
+
+    def with_state(self, *args, **kwargs) -> dict[str, typing.Any]:
+        """
+            The keyword arguments for the route's functions: `kwargs`, plus the route's `state` if it has one (and they
+            don't already).
+        """
+        if self.state is None or "state" in kwargs:
+            return kwargs
+        return {**kwargs, "state": self.state(*args, **kwargs)}
+
+    def render_tagged(self, imgformat: ImageFormat, *args, **kwargs) -> tuple[bytes, str]:
+        kwargs = self.with_state(*args, **kwargs)
+        if render_pool.executor is not None:
+            return render_pool.render(self.name, imgformat, *args, **kwargs)
+        data = render(self.route_handler, self.epd, imgformat, *args, static_layers=self.static_layers, **kwargs)
+        return data, etag_for(data)
+
+    def rendered(self, imgformat: ImageFormat, *args, **kwargs) -> tuple[bytes, str]:
+        """
+            The encoded image and its ETag, from the render cache if the route has a cache key.
+        """
+        # Once, so that the key and the image it's cached under agree.
+        kwargs = self.with_state(*args, **kwargs)
+        if self.cache_key is None:
+            return self.render_tagged(imgformat, *args, **kwargs)
+        key = (self.name, imgformat, self.cache_key(*args, **kwargs))
+        return render_cache.get_or_create(key, lambda: self.render_tagged(imgformat, *args, **kwargs))
+
+
+# Every route wrapped by `serve_image`, e.g. for pre-rendering.
+image_routes: list[ImageRoute] = []
+
+
+def serve_image(route_handler: callable, epd: EPaperDisplay, cache_key: typing.Callable[..., typing.Hashable] = None,
+                next_change: typing.Callable[[float], float | None] = None, static_layers: StaticLayers = None,
+                state: typing.Callable[..., typing.Any] = None):
+    """
+        Wrap a route that draws onto an image, so that it serves the encoded image.
+
+        If `state` is given, it's called once per render with the route's arguments, and what it returns (which must
+        pickle, for `render_pool`) is passed as `state=` to `cache_key`, `static_layers` and the route itself. Routes
+        that depend on the clock or the schedule should work out what they show there, so that the key, the layers
+        and the drawing can't each see a different moment.
+
+        If `cache_key` is given, it's called with the route's arguments and should return a (hashable) summary of
+        everything that's visible in the image, e.g. `(days, next_gp.uid)`. Encoded images are cached on that key.
+        Event UIDs in the key tie the image to those events, and it's dropped when they change (`invalidate_events`).
+        If `next_change` is given, it's called with a time and returns the first time after it at which the image looks
+        different (or None if it won't change), so that it can be rendered ahead of time.
+        If `static_layers` is given, it's called with the route's arguments and returns a key and a function that
+        paints the parts of the image that stay the same while the key does (backgrounds, banners, captions). They're
+        painted once per key and cached, and the route draws the rest onto a copy.
+
+        Responses carry a strong ETag, and a matching `If-None-Match` gets a 304 with no body. Routes with
+        `next_change` also send `X-Next-Refresh` (epoch seconds), which tells the frame when to wake up next.
+
+        `?format=delta` responds with the changes since the raw framebuffer named by `If-None-Match` (falling back to
+        the full raw framebuffer if we don't have that one any more). Its ETag is that of the full raw framebuffer.
+    """
+    image_route = ImageRoute(route_handler, epd, cache_key, next_change, static_layers, state)
+    image_routes.append(image_route)
+
     def wrapper(*args, **kwargs):
-        if request.query.format.lower() not in {'png', 'bmp'}:
+        if request.query.format.lower() not in CONTENT_TYPES:
             imgformat = 'png'
             print("Warning: ?format= not provided. Falling back to png.")
         else:
             imgformat = request.query.format.lower()
 
-        imgformat: typing.Literal['png', 'bmp']
+        imgformat: ImageFormat | typing.Literal['delta']
 
-        # This depends on the enum having WHITE defined.
-        # noinspection PyUnresolvedReferences
-        img = Image.new("P", (epd.WIDTH, epd.HEIGHT), color=epd.palette.WHITE.value)
-        img.putpalette(epd.palette.to_palette())
-        draw = ImageDraw.Draw(img)
+        if imgformat == 'delta':
+            data, etag = image_route.rendered('raw', *args, **kwargs)
+        else:
+            data, etag = image_route.rendered(imgformat, *args, **kwargs)
+        if imgformat in {'raw', 'delta'}:
+            framebuffers.put(etag, data)
 
-        route_handler(draw, *args, epd=epd, **kwargs)
+        headers = {'ETag': etag, 'Cache-Control': CACHE_CONTROL}
+        if (next_refresh := image_route.next_refresh()) is not None:
+            headers['X-Next-Refresh'] = str(next_refresh)
 
-        # https://stackoverflow.com/a/10170635
-        img_io = BytesIO()
-        if imgformat == 'png':
-            img.save(img_io, format='PNG', optimize=True, bits=epd.palette.palette_bits())
-        elif imgformat == 'bmp':
-            img.save(img_io, format='BMP', optimize=True, bits=epd.palette.palette_bits())
+        if_none_match = request.get_header('If-None-Match')
+        if etag_matches(if_none_match, etag):
+            metrics.count("responses", route=image_route.name, format=imgformat, status="304")
+            return HTTPResponse(status=304, headers=headers)
 
-        img_io.seek(0)
+        if imgformat == 'delta' and if_none_match:
+            base_etag = if_none_match.split(",")[0].strip()
+            if (base := framebuffers.get(base_etag)) is not None:
+                raw = data
+                data = deltas.get_or_create((base_etag, etag), lambda: timed_delta(base, raw))
 
-        content_type = f"image/{imgformat}"
+        metrics.count("responses", route=image_route.name, format=imgformat, status="200")
+        metrics.count("response_bytes", len(data), route=image_route.name, format=imgformat)
+
+        content_type = CONTENT_TYPES[imgformat]
         response.set_header('Content-type', content_type)
-        return img_io.read()
+        for name, value in headers.items():
+            response.set_header(name, value)
+        # The frame sizes its download buffer from this, so always send it (rather than relying on the server).
+        response.set_header('Content-Length', str(len(data)))
+        return data
 
+    wrapper.image_route = image_route
     return wrapper
 
 
-def serve_image_inky(r_h: callable):
-    return serve_image(r_h, EPD_INKY)
+def timed_delta(base: bytes, raw: bytes) -> bytes:
+    with metrics.timer("delta"):
+        return encode_delta(base, raw)
+
+
+def serve_image_inky(r_h: callable = None, *, cache_key: typing.Callable[..., typing.Hashable] = None,
+                     next_change: typing.Callable[[float], float | None] = None, static_layers: StaticLayers = None,
+                     state: typing.Callable[..., typing.Any] = None):
+    """
+        Can be used bare (`@serve_image_inky`) or with arguments (`@serve_image_inky(cache_key=...)`).
+    """
+    if r_h is None:
+        return lambda r: serve_image(r, EPD_INKY, cache_key, next_change, static_layers, state)
+    return serve_image(r_h, EPD_INKY, cache_key, next_change, static_layers, state)
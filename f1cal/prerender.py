@@ -0,0 +1,89 @@
+"""
+    Renders images into the render cache shortly before they change (e.g. when the day count ticks down), so that the
+    first frame to wake afterwards doesn't pay for fetching, drawing and encoding.
+"""
+
+import threading
+import time
+
+from . import clock
+from .pillow_helpers import ImageRoute
+
+__all__ = ["Prerenderer"]
+
+# Formats the frames ask for: the raw framebuffer also backs ?format=delta.
+DEFAULT_FORMATS = ('png', 'raw')
+
+# How long before a change to render it. Needs to be less than the render cache's expiry.
+DEFAULT_LEAD = 60
+
+# Look again at least this often, in case the calendar changed under us.
+DEFAULT_MAX_SLEEP = 60 * 60
+
+
+class Prerenderer(threading.Thread):
+    routes: list[ImageRoute]
+    formats: tuple[str, ...]
+    lead: float
+    max_sleep: float
+
+    def __init__(self, routes: list[ImageRoute], formats: tuple[str, ...] = DEFAULT_FORMATS,
+                 lead: float = DEFAULT_LEAD, max_sleep: float = DEFAULT_MAX_SLEEP):
+        super().__init__(name="f1cal-prerenderer", daemon=True)
+        self.routes = routes
+        self.formats = formats
+        self.lead = lead
+        self.max_sleep = max_sleep
+        self._stop_event = threading.Event()
+        # (route name, change time) pairs that have already been rendered.
+        self._done: set[tuple[str, float]] = set()
+
+    def run(self):
+        # Warm the cache with how everything looks right now.
+        for image_route in self.routes:
+            self.prerender(image_route, clock.now())
+
+        while not self._stop_event.is_set():
+            now = time.time()
+            upcoming = self.upcoming(now)
+
+            for t, image_route in upcoming:
+                if t - self.lead <= now and (image_route.name, t) not in self._done:
+                    print(f"Pre-rendering {image_route.name} for {time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t))}")
+                    # Just after the change, so that we render the new state.
+                    self.prerender(image_route, t + 1)
+                    self._done.add((image_route.name, t))
+
+            self._done = {(name, t) for name, t in self._done if t > now}
+
+            wake = min([t - self.lead for t, image_route in upcoming if (image_route.name, t) not in self._done],
+                       default=now + self.max_sleep)
+            self._stop_event.wait(min(max(wake - time.time(), 1), self.max_sleep))
+
+    def upcoming(self, now: float) -> list[tuple[float, ImageRoute]]:
+        """
+            The next change of each route that knows when it changes.
+        """
+        changes = []
+        for image_route in self.routes:
+            if image_route.next_change is None:
+                continue
+            try:
+                t = image_route.next_change(now)
+            except Exception as e:
+                print(f"Warning: couldn't work out when {image_route.name} next changes: {e!r}")
+                continue
+            if t is not None and t > now:
+                changes.append((t, image_route))
+        return changes
+
+    def prerender(self, image_route: ImageRoute, t: float):
+        try:
+            with clock.pinned(t):
+                for imgformat in self.formats:
+                    image_route.rendered(imgformat)
+        except Exception as e:
+            print(f"Warning: pre-rendering {image_route.name} failed: {e!r}")
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,88 @@
+"""
+    An optional pool of render processes.
+
+    Drawing text and encoding images hold the GIL for much of their time, so with Waitress' threads alone, rendering
+    throughput stops scaling after a couple of cores. Once `start()` has been called, `ImageRoute.render_tagged` sends
+    its work here instead; the render cache, ETags and everything else about the request stay in the server process.
+
+    Each worker imports the routes, reads the fonts and loads the schedule snapshot (or failing that, the calendars
+    from the on-disk cache) when it starts, then renders each route once so that the faces and layouts it needs are
+    warm. Workers never fetch the calendars themselves: the server writes them (and the snapshot) to disk, and workers
+    reload them when they change.
+"""
+
+import multiprocessing
+import os
+import typing
+from concurrent.futures import ProcessPoolExecutor
+
+from . import clock, metrics
+from .data_sources import schedule
+
+__all__ = ["start", "shutdown", "render", "executor"]
+
+executor: ProcessPoolExecutor | None = None
+
+
+def start(workers: int) -> ProcessPoolExecutor:
+    """
+        Start `workers` render processes, and route renders through them from now on.
+    """
+    global executor
+    # spawn rather than fork: the server has threads (Waitress, the refresher) that a fork would copy mid-flight.
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_worker,
+                                   initargs=(schedule.feed_config(), schedule.fast_parser, metrics.sample_rate))
+    return executor
+
+
+def shutdown():
+    global executor
+    if executor is not None:
+        executor.shutdown(cancel_futures=True)
+        executor = None
+
+
+def render(name: str, imgformat: str, *args, **kwargs) -> tuple[bytes, str]:
+    """
+        Render the image route called `name` in a worker, as it looks now (as far as `clock` is concerned).
+        Returns the encoded image and its ETag.
+    """
+    data, etag, observations = executor.submit(_render, name, imgformat, clock.now(), args, kwargs).result()
+    metrics.replay(observations)
+    return data, etag
+
+
+def _init_worker(feeds: list[tuple[str, str]], fast_parser: bool, sample_rate: float):
+    # Imported here, not at the top: these import this module.
+    from . import font, routes
+    from .pillow_helpers import image_routes
+
+    font.preload()
+    metrics.sample_rate = sample_rate
+    schedule.configure(feeds, fast_parser)
+    schedule.set_background()
+    schedule.set_offline()
+    schedule.save_snapshots = False
+    if not schedule.load_snapshot():
+        schedule.load_disk()
+
+    for image_route in image_routes:
+        try:
+            image_route.render_tagged('png')
+        except Exception as e:
+            print(f"Warning: render worker {os.getpid()} couldn't warm up {image_route.name}: {e!r}")
+    print(f"Render worker {os.getpid()} ready ({len(image_routes)} routes from {routes.__name__})")
+
+
+def _render(name: str, imgformat: str, t: float, args: tuple,
+            kwargs: dict[str, typing.Any]) -> tuple[bytes, str, list]:
+    from .pillow_helpers import image_routes
+
+    with metrics.captured() as observations:
+        schedule.reload_if_changed()
+        image_route = next(image_route for image_route in image_routes if image_route.name == name)
+        with clock.pinned(t):
+            data, etag = image_route.render_tagged(imgformat, *args, **kwargs)
+    # The server records this worker's timings (see `metrics`).
+    return data, etag, observations
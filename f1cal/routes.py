@@ -1,11 +1,31 @@
-from PIL import ImageDraw
-from bottle import route, default_app
-from datetime import datetime as dt, timezone as tz
+from PIL import Image, ImageDraw, ImageFont
+from bottle import hook, request, route, default_app, response
 from typing import Final
 
+from . import clock, metrics, telemetry
 from .data_sources import schedule
+from .data_sources.events import F1Event
+from .caching import LRUCache
 from .font import F1Reg, F1Bold, F1Wide
-from .pillow_helpers import serve_image_inky, EPaperDisplay, InkyCol, break_lines
+from .pillow_helpers import serve_image_inky, EPaperDisplay, InkyCol, draw_text, fit_text, invalidate_events
+
+SECONDS_PER_DAY: Final[int] = 24 * 60 * 60
+
+
+# Stands in for the next GP's UID in the cache key of the countdown when there isn't one.
+OFF_SEASON: Final[str] = "off-season"
+
+
+def drop_changed_images(changes):
+    uids = changes.uids
+    # Any new event might be next season's first GP, so the off-season image has to go.
+    if changes.added:
+        uids = uids | {OFF_SEASON}
+    if (dropped := invalidate_events(uids)) > 0:
+        print(f"Dropped {dropped} cached images of changed events")
+
+
+schedule.on_change(drop_changed_images)
 
 # import debug routes
 # from .debug_routes import app as debug_app
@@ -16,13 +36,26 @@ def debug_schedule():
     # TODO: move this out and put it in some nice web page.
     return repr(schedule.get_next_grand_prix())
 
+@route('/debug/devices')
+def debug_devices():
+    return telemetry.summary()
+
+@hook('before_request')
+def receive_telemetry():
+    telemetry.receive(request.get_header('X-Device-Id'), request.get_header('X-Telemetry'))
+
+@route('/metrics')
+def metrics_text():
+    response.content_type = metrics.CONTENT_TYPE
+    return metrics.render()
+
 @route('/')
 def index():
     return "Hello, world!"
 
 
 @route('/inky/hello')
-@serve_image_inky
+@serve_image_inky(cache_key=lambda: ())
 def hello_inky(draw: ImageDraw, epd: EPaperDisplay):
     """
         "Test pattern" colour bars
@@ -39,7 +72,7 @@ def hello_inky(draw: ImageDraw, epd: EPaperDisplay):
 
 
 @route('/inky/text')
-@serve_image_inky
+@serve_image_inky(cache_key=lambda: ())
 def text_inky(draw: ImageDraw, epd: EPaperDisplay):
     draw.rectangle([0, 0, epd.WIDTH, epd.HEIGHT], fill=InkyCol.RED.value)
 
@@ -54,15 +87,14 @@ def text_inky(draw: ImageDraw, epd: EPaperDisplay):
 
     script1_y = margin
 
-    font = F1Reg(36)
-    lines = list(break_lines(script1, draw, font, active_width))
+    # Headlines shrink to fit their half of the screen if they have to.
+    font, lines = fit_text(script1, draw, (active_width, epd.HEIGHT / 2 - script1_y), F1Reg, max_size=36)
     draw.multiline_text([epd.WIDTH / 2, script1_y], anchor="ma", text='\n'.join(lines), fill=InkyCol.BLACK.value,
                         font=font)
     bbox1 = draw.multiline_textbbox([epd.WIDTH / 2, script1_y], anchor="ma", text='\n'.join(lines), font=font)
 
     script2 = script2.upper()
-    font = F1Bold(56)
-    lines = list(break_lines(script2, draw, font, active_width))
+    font, lines = fit_text(script2, draw, (active_width, epd.HEIGHT * 0.75 - bbox1[3]), F1Bold, max_size=56)
     draw.multiline_text([
         bbox1[0],
         bbox1[3] + margin / 2
@@ -71,76 +103,163 @@ def text_inky(draw: ImageDraw, epd: EPaperDisplay):
         text='\n'.join(lines), fill=InkyCol.WHITE.value, font=font)
 
     script3 = "123456790"
-    pt = epd.WIDTH / len(script3)
+    font, _ = fit_text(script3, draw, (epd.WIDTH, None), F1Bold, max_lines=1, max_size=epd.WIDTH / len(script3))
+    draw.multiline_text([epd.WIDTH, epd.HEIGHT], anchor="rd", text=script3, fill=InkyCol.ORANGE.value, font=font)
 
-    while True:
-        lines = list(break_lines(script3, draw, F1Bold(pt), epd.WIDTH))
-        if len(lines) > 1:
-            pt -= 2
-        else:
-            break
-    draw.multiline_text([epd.WIDTH, epd.HEIGHT], anchor="rd", text=script3, fill=InkyCol.ORANGE.value, font=F1Bold(pt))
 
+CountdownState = tuple[F1Event | None, int | None]
 
-@route('/inky/countdown')
-@serve_image_inky
-def countdown_inky(draw: ImageDraw, epd: EPaperDisplay):
+
+def countdown_state() -> CountdownState:
+    """
+        The next GP and how many (whole) days there are until it, or (None, None) if there isn't one scheduled. Worked
+        out once per render, for the key, the static layers and the drawing alike.
+    """
     next_gp = schedule.get_next_grand_prix()
-    days: int = (next_gp.DTSTART - dt.now(tz.utc)).days
+    if next_gp is None:
+        return None, None
+    days: int = (next_gp.dtstart - clock.now_datetime()).days
+    return next_gp, days
+
+
+def countdown_key(state: CountdownState):
+    next_gp, days = state
+    if next_gp is None:
+        return OFF_SEASON
+    return days, next_gp.uid
+
+
+def countdown_next_change(now: float) -> float | None:
+    """
+        When the countdown next looks different: when the day count ticks down, or when the next GP starts (and so
+        stops being the next GP).
+    """
+    next_gp = schedule.get_next_grand_prix(now)
+    if next_gp is None:
+        return None
+
+    days = int((next_gp.start - now) // SECONDS_PER_DAY)
+    if days > 0:
+        # The count is still `days` at exactly `days` days to go; it's a second later that it's definitely gone down.
+        return next_gp.start - days * SECONDS_PER_DAY + 1
+    # Whereas a GP stops being the next one as it starts.
+    return next_gp.start
+
+
+# For measuring text outside of a route (a palette image's draw, so with the same font mode as the routes').
+_measure = ImageDraw.Draw(Image.new("P", (1, 1)))
+_countdown_numbers: LRUCache[tuple[ImageFont.FreeTypeFont, tuple[int, int, int, int]]] = LRUCache(16)
+metrics.register_cache("countdown_numbers", _countdown_numbers)
+
+
+def countdown_number(days: int, epd: EPaperDisplay) -> tuple[ImageFont.FreeTypeFont, tuple[int, int, int, int]]:
+    """
+        The font for the day count, and where it goes: in the centre of the screen. Both the static layers and the
+        number need it, so it's cached.
+    """
+    def layout():
+        # Big enough for three digits; only shrinks if there are more than that.
+        font, _ = fit_text(str(days), _measure, (epd.WIDTH, None), F1Bold, max_lines=1, max_size=300)
+        bb = _measure.textbbox((epd.WIDTH / 2, epd.HEIGHT / 2), str(days), font=font, anchor="mm")
+        return font, bb
+
+    return _countdown_numbers.get_or_create((days, epd.WIDTH, epd.HEIGHT), layout)
 
+
+def countdown_static(epd: EPaperDisplay, state: CountdownState):
+    """
+        The countdown's static layers: everything but the day count (or, in race week, the GP's name). Off-season,
+        that's everything.
+    """
+    next_gp, days = state
+    if next_gp is None:
+        return OFF_SEASON, off_season_background
     if days < 7:
-        return raceweek_inky(draw, epd)
+        return "raceweek", raceweek_background
+
+    # The caption sits under the number, so moves with its height.
+    _, bb = countdown_number(days, epd)
+    caption_y = bb[3] + 8
+
+    def paint(draw: ImageDraw, epd: EPaperDisplay):
+        draw.rectangle([0, 0, epd.WIDTH, epd.WIDTH], fill=InkyCol.BLACK.value)
+
+        caption = "days to go"
+        draw_text(
+            draw,
+            (
+                epd.WIDTH / 2,
+                caption_y
+            ),
+            anchor="ma",
+            text=caption,
+            font=F1Reg(52),
+            fill=InkyCol.RED.value
+        )
+
+        draw_text(draw, (0, 0), anchor="la", text="2026 Formula 1 World Championship", font=F1Wide(18),
+                  fill=InkyCol.WHITE.value)
 
-    draw.rectangle([0, 0, epd.WIDTH, epd.WIDTH], fill=InkyCol.BLACK.value)
+    return ("countdown", caption_y), paint
 
-    font = F1Bold(300)
+
+@route('/inky/countdown')
+@serve_image_inky(cache_key=countdown_key, next_change=countdown_next_change, static_layers=countdown_static,
+                  state=countdown_state)
+def countdown_inky(draw: ImageDraw, epd: EPaperDisplay, state: CountdownState):
+    next_gp, days = state
+
+    if next_gp is None:
+        # All in the static layers (off_season_background).
+        return
+    if days < 7:
+        return raceweek_inky(draw, epd, next_gp)
+
+    font, _ = countdown_number(days, epd)
 
     # Draw number in center of screen
-    draw.text(
-        [
+    draw_text(
+        draw,
+        (
             epd.WIDTH / 2,
             epd.HEIGHT / 2
-        ],
+        ),
         anchor="mm",
         text=str(days),
         font=font,
         fill=InkyCol.WHITE.value
     )
 
-    bb = draw.textbbox(
-        [
-            epd.WIDTH / 2,
-            epd.HEIGHT / 2
-        ],
-        anchor="mm",
-        text=str(days), font=font)
 
-    caption = "days to go"
-    draw.text(
-        [
-            epd.WIDTH / 2,
-            bb[3] + 8
-        ],
-        anchor="ma",
-        text=caption,
-        font=F1Reg(52),
-        fill=InkyCol.RED.value
-    )
+def off_season_background(draw: ImageDraw, epd: EPaperDisplay):
+    """
+        Shown when there are no more GPs in the calendar, until next season's are added.
+    """
+    draw.rectangle([0, 0, epd.WIDTH, epd.HEIGHT], fill=InkyCol.BLACK.value)
+
+    draw_text(draw, (epd.WIDTH / 2, epd.HEIGHT / 2), anchor="md", text="See you", font=F1Bold(96),
+              fill=InkyCol.WHITE.value)
+    draw_text(draw, (epd.WIDTH / 2, epd.HEIGHT / 2 + 8), anchor="ma", text="next season", font=F1Reg(52),
+              fill=InkyCol.RED.value)
+
+    draw_text(draw, (0, 0), anchor="la", text="2026 Formula 1 World Championship", font=F1Wide(18),
+              fill=InkyCol.WHITE.value)
+
 
-    draw.text([0, 0], anchor="la", text="2026 Formula 1 World Championship", font=F1Wide(18), fill=InkyCol.WHITE.value)
+RACEWEEK_MARGIN: Final[int] = 16
 
 
-# Not annotated because it's delegated to from countdown_inky
-def raceweek_inky(draw : ImageDraw, epd: EPaperDisplay):
+def raceweek_background(draw: ImageDraw, epd: EPaperDisplay):
     draw.rectangle([0,0, epd.WIDTH, epd.HEIGHT], fill=InkyCol.RED.value)
 
     font = F1Bold(180)
 
-    margin = 16
+    margin = RACEWEEK_MARGIN
 
-    textAnchor = [epd.WIDTH / 2, 20]
+    textAnchor = (epd.WIDTH / 2, 20)
 
-    draw.text(
+    bb = draw_text(
+        draw,
         textAnchor,
         anchor="rt",
         text="RA",
@@ -148,13 +267,12 @@ def raceweek_inky(draw : ImageDraw, epd: EPaperDisplay):
         fill=InkyCol.WHITE.value
     )
 
-    draw.text(textAnchor, anchor="lt",text="WE", font=font, fill=InkyCol.BLACK.value)
+    draw_text(draw, textAnchor, anchor="lt", text="WE", font=font, fill=InkyCol.BLACK.value)
 
-    bb = draw.textbbox(textAnchor, anchor="rt", text="RA", font=font)
+    textAnchor = (textAnchor[0], bb[3] + margin)
 
-    textAnchor[1] = bb[3] + margin
-
-    draw.text(
+    bb = draw_text(
+        draw,
         textAnchor,
         anchor="rt",
         text="CE",
@@ -162,17 +280,17 @@ def raceweek_inky(draw : ImageDraw, epd: EPaperDisplay):
         fill=InkyCol.WHITE.value
     )
 
-    draw.text(textAnchor, anchor="lt", text="EK", font=font, fill=InkyCol.BLACK.value)
+    draw_text(draw, textAnchor, anchor="lt", text="EK", font=font, fill=InkyCol.BLACK.value)
 
-    bb = draw.textbbox(textAnchor,
-        anchor="rt",
-        text="CE",
-        font=font)
-    
-    next_gp = schedule.get_next_grand_prix()
-    font = F1Reg(28)
+
+# Not annotated because it's delegated to from countdown_inky, which paints raceweek_background under it
+def raceweek_inky(draw : ImageDraw, epd: EPaperDisplay, next_gp: F1Event):
+    margin = RACEWEEK_MARGIN
+
+    font, _ = fit_text(next_gp.summary, draw, (epd.WIDTH - margin * 2, None), F1Reg, max_lines=1, max_size=28)
 
     # TODO: strip "F1: Grand Prix (...)" from the event
-    draw.text([epd.WIDTH / 2, epd.HEIGHT - 8], anchor="mb", text=next_gp.summary, font=font, fill=InkyCol.BLACK.value)
+    draw_text(draw, (epd.WIDTH / 2, epd.HEIGHT - 8), anchor="mb", text=next_gp.summary, font=font,
+              fill=InkyCol.BLACK.value)
 
     # next_gp.
@@ -0,0 +1,162 @@
+"""
+    Wake telemetry from the frames: how long each stage of a wake took, so we can see where the battery goes.
+
+    A frame keeps a record of each wake in flash (see micropython/main.py), and sends the ones it hasn't delivered yet
+    with its next request, as JSON in `X-Telemetry`, along with its `X-Device-Id`. Records are aggregated here per
+    device (served on /debug/devices), and added to fleet-wide counters on /metrics. Those have no device label:
+    anyone can make up device IDs, and only the per-device statistics are bounded (by MAX_DEVICES).
+"""
+
+import json
+import math
+import re
+import threading
+import time
+
+from . import metrics
+from .caching import LRUCache
+
+__all__ = ["receive", "summary", "STAGES"]
+
+# Milliseconds spent in each stage of a wake.
+STAGES = ("wifi_ms", "ntp_ms", "download_ms", "decode_ms", "refresh_ms")
+# Other numbers a record may carry, totalled per device.
+COUNTS = ("wifi_attempts", "ntp_attempts", "download_bytes")
+# Free heap (bytes) at the tightest point of the wake; we keep the lowest.
+FREE_RAM = "free_ram"
+
+# The largest believable value of each field; bigger ones (or infinities) would swamp the totals, so are dropped.
+MAX_VALUES = {
+    # No stage takes a day.
+    **{name: 24 * 60 * 60 * 1000 for name in STAGES},
+    "wifi_attempts": 1000,
+    "ntp_attempts": 1000,
+    # A full raw framebuffer, uncompressed, is under 200KB.
+    "download_bytes": 16 * 1024 * 1024,
+    # More than any frame has.
+    FREE_RAM: 1024 * 1024 * 1024,
+}
+
+# Devices we keep statistics for; the one seen least recently is forgotten first.
+MAX_DEVICES = 256
+# More than a frame should ever have pending (it keeps a few), so anything bigger isn't from a frame.
+MAX_HEADER_LENGTH = 4096
+DEVICE_ID_PATTERN = re.compile(r"[0-9A-Za-z_-]{1,32}")
+
+
+class DeviceStats:
+    """
+        Everything a device has reported: totals of each field (and how many records had it), and the latest record.
+    """
+    wakes: int
+    last_seen: float
+    totals: dict[str, float]
+    reported: dict[str, int]
+    min_free_ram: int | None
+    last: dict[str, int | float]
+
+    def __init__(self):
+        self.wakes = 0
+        self.last_seen = 0
+        self.totals = {}
+        self.reported = {}
+        self.min_free_ram = None
+        self.last = {}
+
+    def add(self, record: dict[str, int | float], now: float):
+        self.wakes += 1
+        self.last_seen = now
+        self.last = record
+        for name in STAGES + COUNTS:
+            if name in record:
+                self.totals[name] = self.totals.get(name, 0) + record[name]
+                self.reported[name] = self.reported.get(name, 0) + 1
+        if FREE_RAM in record and (self.min_free_ram is None or record[FREE_RAM] < self.min_free_ram):
+            self.min_free_ram = record[FREE_RAM]
+
+    def means(self) -> dict[str, float]:
+        return {name: self.totals[name] / self.reported[name] for name in self.totals}
+
+
+_devices: LRUCache[DeviceStats] = LRUCache(MAX_DEVICES)
+_lock = threading.Lock()
+
+
+def parse_records(header: str) -> list[dict[str, int | float]]:
+    """
+        The records in an `X-Telemetry` header: a JSON list of objects (or just one object). Fields we don't know, or
+        that aren't numbers between 0 and their MAX_VALUES, are dropped. Raises ValueError if it isn't that.
+    """
+    if len(header) > MAX_HEADER_LENGTH:
+        raise ValueError(f"{len(header)} characters is too long")
+    try:
+        records = json.loads(header)
+    except RecursionError:
+        # Nested deeper than the parser goes, which no frame would send.
+        raise ValueError("Nested too deeply") from None
+    if isinstance(records, dict):
+        records = [records]
+    if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+        raise ValueError("Expected a list of objects")
+
+    return [{name: value for name, value in record.items()
+             if name in MAX_VALUES and isinstance(value, (int, float)) and not isinstance(value, bool)
+             and math.isfinite(value) and 0 <= value <= MAX_VALUES[name]}
+            for record in records]
+
+
+def receive(device_id: str | None, header: str | None):
+    """
+        Record the telemetry sent with a request, if there is any. Bad telemetry is logged and otherwise ignored: it
+        mustn't get in the way of the request.
+    """
+    if not header:
+        return
+    if device_id is None or not DEVICE_ID_PATTERN.fullmatch(device_id):
+        print(f"Warning: ignoring telemetry from unidentified device {device_id!r}")
+        return
+    try:
+        records = parse_records(header)
+    except ValueError as e:
+        print(f"Warning: ignoring bad telemetry from {device_id}: {e}")
+        return
+
+    now = time.time()
+    with _lock:
+        stats = _devices.get_or_create(device_id, DeviceStats)
+        for record in records:
+            stats.add(record, now)
+
+    for record in records:
+        metrics.count("device_wakes")
+        for name in STAGES:
+            if name in record:
+                metrics.count("device_stage_milliseconds", record[name], stage=name[:-3])
+        if "download_bytes" in record:
+            metrics.count("device_download_bytes", record["download_bytes"])
+
+
+def summary() -> dict:
+    """
+        Per-device statistics, and the mean time per wake of each stage across all devices (slowest first).
+    """
+    with _lock:
+        devices = dict(_devices.items())
+        report = {
+            device_id: {
+                "wakes": stats.wakes,
+                "last_seen": stats.last_seen,
+                "means": stats.means(),
+                "min_free_ram": stats.min_free_ram,
+                "last": stats.last,
+            }
+            for device_id, stats in devices.items()
+        }
+        totals = {name: sum(stats.totals.get(name, 0) for stats in devices.values()) for name in STAGES}
+        reported = {name: sum(stats.reported.get(name, 0) for stats in devices.values()) for name in STAGES}
+
+    fleet = {name: totals[name] / reported[name] for name in STAGES if reported[name]}
+    return {
+        "devices": report,
+        "fleet_stage_means_ms": dict(sorted(fleet.items(), key=lambda item: item[1], reverse=True)),
+    }
@@ -1,11 +1,14 @@
 import time
 import gc
+import json
+import struct
 
 import machine
+import micropython
 
 import ntptime
 
-from urllib import urequest
+import socket
 import inky_helper as ih
 from inky_frame import BLACK, WHITE, GREEN, BLUE, RED, YELLOW, ORANGE, TAUPE
 import inky_frame
@@ -17,6 +20,56 @@ WIFI_NUM_ATTEMPTS = 1
 NTP_NUM_ATTEMPTS = 5
 NTP_TIMEOUT_SECONDS = 15
 
+ETAG_FILE = "/etag.txt"
+
+# Timings of past wakes not yet delivered to the server (see f1cal/telemetry.py): a JSON list of records, sent with
+# the next image request. Only the latest few are kept, in case the server is unreachable for a while.
+TELEMETRY_FILE = "/telemetry.json"
+TELEMETRY_MAX_RECORDS = 4
+
+# Downloads are read from the socket in chunks of this size.
+DOWNLOAD_CHUNK_SIZE = 4096
+# Initial buffer size, only used when the server doesn't send a Content-Length.
+DOWNLOAD_FALLBACK_SIZE = 32 * 1024
+
+# Returned by draw_image_from_web when the server says the image hasn't changed since last time.
+NOT_MODIFIED = "not modified"
+
+# "raw" is a packed, deflated framebuffer (see f1cal/encoders.py), drawn row by row as runs of colour; "png" goes
+# through pngdec.
+# "delta" is like raw, but only the parts that changed since last time (see f1cal/delta.py), patched into a copy of
+# the framebuffer kept in flash.
+IMAGE_FORMAT = "delta"
+RAW_HEADER_FORMAT = ">4sBBBxHHH"
+RAW_HEADER_SIZE = struct.calcsize(RAW_HEADER_FORMAT)
+RAW_MAGIC = b"F1FB"
+RAW_VERSION = 1
+RAW_COMPRESSION_ZLIB = 1
+DELTA_HEADER_FORMAT = ">4sBBBxHHHH"
+DELTA_HEADER_SIZE = struct.calcsize(DELTA_HEADER_FORMAT)
+DELTA_MAGIC = b"F1DL"
+DELTA_RECT_FORMAT = ">HHHH"
+DELTA_RECT_SIZE = struct.calcsize(DELTA_RECT_FORMAT)
+FRAMEBUFFER_FILE = "/framebuffer.bin"
+
+# How long to sleep between updates, in minutes. The server says when the image next changes (X-Next-Refresh);
+# without that (or without a clock to compare it to), check every DEFAULT_SLEEP_MINUTES.
+DEFAULT_SLEEP_MINUTES = 120
+MIN_SLEEP_MINUTES = 5
+# sleep_for sets an hour:minute alarm, so it can't be a day or more away.
+MAX_SLEEP_MINUTES = 23 * 60
+# Wake a little after the change, in case our clock is ahead of the server's.
+SLEEP_MARGIN_MINUTES = 1
+
+# Epoch seconds of the image's next change, from the last response (None if the server didn't say).
+next_refresh = None
+
+# This wake's record: milliseconds per stage (wifi_ms, ntp_ms, download_ms, decode_ms, refresh_ms), attempts,
+# download_bytes and free_ram.
+telemetry = {}
+# Whether this wake's record is already in TELEMETRY_FILE (it's saved before turn_off(), which returns on USB power).
+telemetry_saved = False
+
 ERROR_BOX_TITLE_WEIGHT = 2
 ERROR_BOX_MESSAGE_WEIGHT = 1
 ERROR_BOX_FONT_SCALE = 2
@@ -86,29 +139,123 @@ def update_rtc():
         print("Unable to contact NTP server:", e)
         return False
 
+def device_id():
+    import ubinascii
+    return ubinascii.hexlify(machine.unique_id()).decode()
+
+
+def load_telemetry():
+    """
+        Records of past wakes that haven't been sent yet.
+    """
+    if not ih.file_exists(TELEMETRY_FILE):
+        return []
+    try:
+        with open(TELEMETRY_FILE, "r") as f:
+            return json.load(f)
+    except ValueError:
+        return []
+
+
+def save_telemetry():
+    """
+        Add this wake's record to the ones waiting to be sent, or update it if it's already there.
+    """
+    global telemetry_saved
+    records = load_telemetry()
+    if telemetry_saved and records:
+        records[-1] = telemetry
+    else:
+        records.append(telemetry)
+    telemetry_saved = True
+    with open(TELEMETRY_FILE, "w") as f:
+        json.dump(records[-TELEMETRY_MAX_RECORDS:], f)
+        f.flush()
+
+
+def clear_telemetry():
+    if ih.file_exists(TELEMETRY_FILE):
+        import os
+        os.remove(TELEMETRY_FILE)
+
+
+def load_etag():
+    if not ih.file_exists(ETAG_FILE):
+        return None
+    with open(ETAG_FILE, "r") as f:
+        return f.read().strip() or None
+
+
+def save_etag(etag):
+    if etag is None:
+        if ih.file_exists(ETAG_FILE):
+            import os
+            os.remove(ETAG_FILE)
+        return
+    with open(ETAG_FILE, "w") as f:
+        f.write(etag)
+        f.flush()
+
+
 def draw_image_from_web():
     """
-        Download an indexed PNG and draw it on the screen
+        Download the image (a raw framebuffer or an indexed PNG, depending on IMAGE_FORMAT) and draw it on the screen.
+        Returns NOT_MODIFIED if the image is the same as the one already on the screen (so there's nothing to draw).
     """
     from secrets import ENDPOINT
     # bars.png is an indexed 480x800 image.
-    url = ENDPOINT + "countdown?format=png"
+    url = ENDPOINT + "countdown?format=" + IMAGE_FORMAT
     print("Opening", url)
     
-    data = download_to_ram(url)
+    last_etag = load_etag()
+    if IMAGE_FORMAT == "delta" and not ih.file_exists(FRAMEBUFFER_FILE):
+        # Nothing to apply a delta to, so ask for the whole thing.
+        last_etag = None
+    headers = {"X-Device-Id": device_id()}
+    if last_etag is not None:
+        headers["If-None-Match"] = last_etag
+    if pending := load_telemetry():
+        headers["X-Telemetry"] = json.dumps(pending)
+
+    start = time.ticks_ms()
+    if IMAGE_FORMAT in ("raw", "delta"):
+        status, etag, drawn = download_framebuffer(url, headers)
+    else:
+        status, etag, data = download_to_ram(url, headers)
+    telemetry["download_ms"] = time.ticks_diff(time.ticks_ms(), start)
+    if status is not None:
+        # The server has had them.
+        clear_telemetry()
+    if status == 304:
+        print(f"Image not modified ({last_etag})")
+        return NOT_MODIFIED
+    # Whatever happens next, the screen won't be showing `last_etag` any more.
+    save_etag(None)
+
+    if IMAGE_FORMAT in ("raw", "delta"):
+        if not drawn:
+            print("Download failed!")
+            return False
+        save_etag(etag)
+        return True
+
     if data is None:
         print("Download failed!")
         return False
     print(f"Download succeeded with buffer size {len(data)}")
     
+    start = time.ticks_ms()
     try:
         png = pngdec.PNG(graphics)
         png.open_RAM(data)
         png.decode()
-        return True
     except RuntimeError as e:
         print("PNG error:", e)
         return False
+    telemetry["decode_ms"] = time.ticks_diff(time.ticks_ms(), start)
+
+    save_etag(etag)
+    return True
     
 def draw_time(bg=WHITE, fg=BLACK):
     graphics.set_font("bitmap8")
@@ -141,35 +288,285 @@ def draw_time(bg=WHITE, fg=BLACK):
     graphics.text(date_str, int(margin), y0 + margin + line_height)
     
     
-def download_to_ram(url):
+def http_get(url, headers=None):
+    """
+        Minimal HTTP/1.0 GET (urequest doesn't let us send headers).
+        Returns (status, headers, socket), with header names lower-cased. The caller must close the socket.
+    """
+    proto, _, host, path = url.split("/", 3)
+    port = 443 if proto == "https:" else 80
+    if ":" in host:
+        host, port = host.split(":", 1)
+        port = int(port)
+
+    ai = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+    s = socket.socket(ai[0], socket.SOCK_STREAM, ai[2])
+    try:
+        s.connect(ai[-1])
+        if proto == "https:":
+            import ssl
+            s = ssl.wrap_socket(s, server_hostname=host)
+        s.write(b"GET /")
+        s.write(path)
+        s.write(b" HTTP/1.0\r\nHost: ")
+        s.write(host)
+        s.write(b"\r\n")
+        for k, v in (headers or {}).items():
+            s.write(k)
+            s.write(b": ")
+            s.write(v)
+            s.write(b"\r\n")
+        s.write(b"\r\n")
+
+        status = int(s.readline().split(None, 2)[1])
+        resp_headers = {}
+        while True:
+            line = s.readline()
+            if not line or line == b"\r\n":
+                break
+            k, v = line.decode().split(":", 1)
+            resp_headers[k.strip().lower()] = v.strip()
+        return status, resp_headers, s
+    except:
+        s.close()
+        raise
+
+
+def note_response(resp_headers):
+    global next_refresh
+    try:
+        next_refresh = int(resp_headers["x-next-refresh"])
+    except (KeyError, ValueError):
+        next_refresh = None
+    try:
+        telemetry["download_bytes"] = int(resp_headers["content-length"])
+    except (KeyError, ValueError):
+        pass
+
+
+def sleep_minutes(clock_set):
+    """
+        Minutes to sleep until the image next changes, going by the server's X-Next-Refresh.
+    """
+    if next_refresh is None or not clock_set:
+        return DEFAULT_SLEEP_MINUTES
+    minutes = int(next_refresh - time.time() + 59) // 60 + SLEEP_MARGIN_MINUTES
+    return max(MIN_SLEEP_MINUTES, min(minutes, MAX_SLEEP_MINUTES))
+
+
+def download_to_ram(url, headers=None):
     """
-        Make a web request and store its output in a single bytearray. If the array is too small, the request is retried until we run out of RAM!
+        Make a web request and store its output in a single buffer, over one connection.
+        The buffer is allocated once from Content-Length; without one, we stream into a preallocated buffer (growing it if we have to).
+        Returns (status, etag, data); data is None for anything other than a 200.
     """
+    sock = None
     try:
-        size = 128
+        status, resp_headers, sock = http_get(url, headers)
+        note_response(resp_headers)
+        if status != 200:
+            return status, None, None
+
+        length = resp_headers.get("content-length")
+        if length is not None:
+            length = int(length)
+            data = bytearray(length)
+            received = read_into(sock, memoryview(data))
+            if received != length:
+                print(f"Connection closed after {received} of {length} bytes")
+                return None, None, None
+            return status, resp_headers.get("etag"), data
+
+        print(f"No Content-Length; streaming into {DOWNLOAD_FALLBACK_SIZE} byte buffer")
+        data = bytearray(DOWNLOAD_FALLBACK_SIZE)
+        received = 0
         while True:
-            socket = urequest.urlopen(url)
-            data = bytearray(size)
-            socket.readinto(data) # Read as much as we can into the buffer
-            if socket.readinto(data) != 0:
-                # There's still data left - so the buffer must not be big enough!
-                print(f"Download failed with buffer size {size}")
-                size *= 2
-                data = None
-                socket.close()
-                gc.collect()
-                continue
+            received += read_into(sock, memoryview(data)[received:])
+            if received < len(data):
+                return status, resp_headers.get("etag"), memoryview(data)[:received]
+            # Filled the buffer, so there may be more to come.
+            print(f"Buffer of {len(data)} bytes filled; growing")
+            data.extend(bytearray(len(data)))
+    except MemoryError:
+        print("MemoryError!")
+        return None, None, None
+    except OSError as e:
+        print("Network error:", e)
+        return None, None, None
+    finally:
+        if sock is not None:
+            sock.close()
+        # While the download's buffers are still allocated: about as tight as memory gets.
+        telemetry["free_ram"] = gc.mem_free()
+        gc.collect()
+
+
+def download_framebuffer(url, headers=None):
+    """
+        Stream a raw framebuffer (or a delta against the one in flash) from the server onto the display, with no
+        image decoding.
+        Returns (status, etag, drawn).
+    """
+    sock = None
+    try:
+        status, resp_headers, sock = http_get(url, headers)
+        note_response(resp_headers)
+        if status != 200:
+            return status, None, False
+
+        header = bytearray(DELTA_HEADER_SIZE)
+        header_mv = memoryview(header)
+        if read_into(sock, header_mv[:4]) != 4:
+            print("Connection closed during framebuffer header")
+            return None, None, False
+        magic = bytes(header[:4])
+        if magic == RAW_MAGIC:
+            header_size = RAW_HEADER_SIZE
+        elif magic == DELTA_MAGIC:
+            header_size = DELTA_HEADER_SIZE
+        else:
+            print(f"Unexpected framebuffer type: {magic}")
+            return None, None, False
+        if read_into(sock, header_mv[4:header_size]) != header_size - 4:
+            print("Connection closed during framebuffer header")
+            return None, None, False
+
+        if magic == RAW_MAGIC:
+            _, version, bits, compression, width, height, stride = struct.unpack(RAW_HEADER_FORMAT, header[:header_size])
+            num_rects = None
+        else:
+            _, version, bits, compression, width, height, stride, num_rects = struct.unpack(DELTA_HEADER_FORMAT, header)
+        if version != RAW_VERSION or bits != 4 or (width, height) != (WIDTH, HEIGHT):
+            print(f"Unexpected framebuffer: {magic} v{version} {bits}bpp {width}x{height}")
+            return None, None, False
+
+        stream = sock
+        if compression == RAW_COMPRESSION_ZLIB:
+            import deflate
+            stream = deflate.DeflateIO(sock, deflate.ZLIB)
+
+        if num_rects is None and IMAGE_FORMAT != "delta":
+            ok = draw_framebuffer(stream, width, height, stride)
+        else:
+            # Bring the copy in flash up to date, then draw from it.
+            if num_rects is None:
+                ok = save_framebuffer(stream, stride * height)
             else:
-                # Full read was successful
-                return data
+                print(f"Patching {num_rects} changed region(s)")
+                ok = patch_framebuffer(stream, num_rects, stride)
+            if ok:
+                with open(FRAMEBUFFER_FILE, "rb") as f:
+                    ok = draw_framebuffer(f, width, height, stride)
+        if not ok:
+            print("Connection closed during framebuffer")
+            return None, None, False
+        return status, resp_headers.get("etag"), True
     except MemoryError:
         print("MemoryError!")
-        return # None
+        return None, None, False
+    except OSError as e:
+        print("Network error:", e)
+        return None, None, False
     finally:
-        socket.close()
+        if sock is not None:
+            sock.close()
+        # While the download's buffers are still allocated: about as tight as memory gets.
+        telemetry["free_ram"] = gc.mem_free()
         gc.collect()
 
+
+def save_framebuffer(stream, size):
+    """
+        Copy a whole framebuffer from `stream` to flash. Returns False if the stream ended early.
+    """
+    chunk = memoryview(bytearray(DOWNLOAD_CHUNK_SIZE))
+    with open(FRAMEBUFFER_FILE, "wb") as f:
+        while size > 0:
+            n = read_into(stream, chunk[:min(size, len(chunk))])
+            if n == 0:
+                return False
+            f.write(chunk[:n])
+            size -= n
+    return True
+
+
+def patch_framebuffer(stream, num_rects, stride):
+    """
+        Overwrite the changed rectangles of the framebuffer in flash, in place. Returns False if the stream ended early.
+    """
+    rect = bytearray(DELTA_RECT_SIZE)
+    row = memoryview(bytearray(stride))
+    with open(FRAMEBUFFER_FILE, "r+b") as f:
+        for _ in range(num_rects):
+            if read_into(stream, memoryview(rect)) != DELTA_RECT_SIZE:
+                return False
+            x, y, w, h = struct.unpack(DELTA_RECT_FORMAT, rect)
+            for r in range(y, y + h):
+                if read_into(stream, row[:w]) != w:
+                    return False
+                f.seek(r * stride + x)
+                f.write(row[:w])
+    return True
+
+
+def draw_framebuffer(stream, width, height, stride):
+    """
+        Read packed 4-bit rows from `stream` onto the display. Returns False if the stream ended early.
+    """
+    # If PicoGraphics exposes a framebuffer in the same layout, read directly into it.
+    try:
+        framebuffer = memoryview(graphics)
+    except TypeError:
+        framebuffer = None
+    if framebuffer is not None and len(framebuffer) == stride * height:
+        return read_into(stream, framebuffer) == len(framebuffer)
+
+    # Otherwise (e.g. the 7.3" frame keeps its framebuffer in PSRAM), draw each row as runs of colour.
+    row = bytearray(stride)
+    row_mv = memoryview(row)
+    for y in range(height):
+        if read_into(stream, row_mv) != stride:
+            return False
+        x = 0
+        while x < width:
+            end = pixel_run_end(row, x, width)
+            graphics.set_pen((row[x >> 1] >> (4 - ((x & 1) << 2))) & 0xF)
+            graphics.pixel_span(x, y, end - x)
+            x = end
+    return True
+
+
+@micropython.viper
+def pixel_run_end(row: ptr8, x: int, width: int) -> int:
+    """
+        Index of the first pixel after `x` with a different colour (or `width`).
+    """
+    colour = (row[x >> 1] >> (4 - ((x & 1) << 2))) & 0xF
+    x += 1
+    while x < width:
+        if ((row[x >> 1] >> (4 - ((x & 1) << 2))) & 0xF) != colour:
+            break
+        x += 1
+    return x
+
+
+def read_into(sock, buf):
+    """
+        Read from `sock` in chunks until `buf` is full or the connection closes. Returns the number of bytes read.
+    """
+    received = 0
+    while received < len(buf):
+        n = sock.readinto(buf[received:received + DOWNLOAD_CHUNK_SIZE])
+        if not n:
+            break
+        received += n
+    return received
+
+
 def draw_error_box(error_title, error_text):
+    # The screen won't show the server's image any more, so don't let the next wake's request say it does.
+    save_etag(None)
+
     graphics.set_pen(TAUPE)
     graphics.clear()
     
@@ -211,9 +608,11 @@ def draw_error_box(error_title, error_text):
 
 
 def update_epd():    
+    start = time.ticks_ms()
     ih.led_warn.on()
     graphics.update()
     ih.led_warn.off()
+    telemetry["refresh_ms"] = time.ticks_diff(time.ticks_ms(), start)
 
 def initialise():
     global graphics, WIDTH, HEIGHT
@@ -235,25 +634,32 @@ if __name__ == "__main__":
         print(e)
         
     # Connect to WiFi
+    start = time.ticks_ms()
     for i in range(WIFI_NUM_ATTEMPTS):
         if (wifi_connected := connect_wifi()):
             break
+    telemetry["wifi_ms"] = time.ticks_diff(time.ticks_ms(), start)
+    telemetry["wifi_attempts"] = i + 1
     if not wifi_connected:
         print(f"Failed to connect to WiFi after {WIFI_NUM_ATTEMPTS} attempts.")
         draw_error_box("Network error", "Could not connect to WiFI. Check that the network SSID and password are correct.")
         update_epd()
         print("update_epd done")
+        save_telemetry()
         inky_frame.turn_off()
         
         
     # (this could go _after_ image draw)
+    start = time.ticks_ms()
     for j in range(NTP_NUM_ATTEMPTS):
         if (ntp_success := update_rtc()):
             break
+    telemetry["ntp_ms"] = time.ticks_diff(time.ticks_ms(), start)
+    telemetry["ntp_attempts"] = j + 1
     if not ntp_success:
         print(f"Failed to update RTC.")
     
-    if not draw_image_from_web():
+    if not (drawn := draw_image_from_web()):
         draw_error_box("HTTP error", "Could not connect to the remote server.")
     else:
         ...
@@ -261,10 +667,17 @@ if __name__ == "__main__":
     
     disconnect_wifi()
     
-    draw_time(BLACK, WHITE)
-    
-    update_epd()
+    if drawn is NOT_MODIFIED:
+        # The screen already shows this image, so don't spend power on a refresh.
+        print("Skipping e-paper update")
+    else:
+        draw_time(BLACK, WHITE)
+
+        update_epd()
     
-    inky_frame.sleep_for(120) # minutes
+    save_telemetry()
+    minutes = sleep_minutes(ntp_success)
+    print(f"Sleeping for {minutes} minutes")
+    inky_frame.sleep_for(minutes)
     
         